@@ -1,13 +1,17 @@
 import argparse
+import importlib
 import os
 import re
+import subprocess
 import sys
 import textwrap
+from types import ModuleType
 from typing import List
 from typing import Optional
 from typing import Tuple
 
-from .main import main
+from .core import repos
+from .exceptions import GitfuException
 
 
 def run() -> int:
@@ -15,9 +19,40 @@ def run() -> int:
     if args.mode == 'init':
         print(get_bash_shim(args.directory))
         return 0
-    else:
-        sys.argv = [sys.argv[0]] + leftover
-        return main()
+    elif args.mode == 'batch':
+        # NOTE: Modes are imported lazily (see `_import_mode`).
+        from . import batch
+        return batch.run(fail_fast=args.fail_fast)
+    elif args.mode == 'tune':
+        from . import tune
+        try:
+            return tune.run(
+                dry_run=args.dry_run,
+                names=args.setting,
+                repeat=args.repeat,
+                as_json=args.json,
+            )
+        except subprocess.CalledProcessError as e:
+            print(e.stderr, file=sys.stderr)
+            return 1
+        except GitfuException as e:
+            print(str(e), file=sys.stderr)
+            return 1
+    elif args.mode == 'fsmonitor':
+        from . import fsmonitor
+        try:
+            return fsmonitor.run(args.action, *args.hook_args)
+        except subprocess.CalledProcessError as e:
+            print(e.stderr, file=sys.stderr)
+            return 1
+
+    from .main import main
+
+    sys.argv = [sys.argv[0]] + leftover
+    if repos.is_requested(args):
+        return repos.run_from_args(args, main, *leftover)
+
+    return main()
 
 
 def parse_args() -> Tuple[argparse.Namespace, List[str]]:
@@ -37,10 +72,78 @@ def parse_args() -> Tuple[argparse.Namespace, List[str]]:
         ),
     )
 
+    batch_parser = subparsers.add_parser(
+        'batch',
+        help='Executes newline-delimited commands from stdin, in a single process.',
+        description=_get_description('batch'),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    batch_parser.add_argument(
+        '--fail-fast',
+        action='store_true',
+        help='Stops at the first command that fails.',
+    )
+
+    fsmonitor_parser = subparsers.add_parser(
+        'fsmonitor',
+        help='Manages the core.fsmonitor hook, which speeds up git in large worktrees.',
+        description=_get_description('fsmonitor'),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    fsmonitor_parser.add_argument(
+        'action',
+        choices=['enable', 'disable', 'status', 'hook', 'watch'],
+        help=(
+            'Use `enable` to install the hook (and start the watcher) for this repository. '
+            '`hook` and `watch` are invoked by git, and the hook respectively.'
+        ),
+    )
+    fsmonitor_parser.add_argument(
+        'hook_args',
+        nargs='*',
+        help=argparse.SUPPRESS,
+    )
+
+    tune = _import_mode('tune')
+    tune_parser = subparsers.add_parser(
+        'tune',
+        help='Measures this repository, and enables git\'s scaling features.',
+        description=tune.__doc__ if tune else None,
+    )
+    tune_parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='Lists recommendations, without changing anything.',
+    )
+    tune_parser.add_argument(
+        '--setting',
+        action='append',
+        choices=[setting.name for setting in tune.SETTINGS] if tune else None,
+        help=(
+            'Only considers this setting (even if not recommended). '
+            'Can be specified multiple times. Defaults to all recommended settings.'
+        ),
+    )
+    tune_parser.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        help='Number of times to run each benchmark. Defaults to 3.',
+    )
+    tune_parser.add_argument(
+        '--json',
+        action='store_true',
+        help='Outputs the report as JSON.',
+    )
+
     run_parser = subparsers.add_parser(
         'run',
         help='Runs shimmed git commands.',
+        # Otherwise, abbreviated git flags may be mistaken for our own.
+        allow_abbrev=False,
     )
+    # NOTE: `--jobs` is not used here, since it is a valid flag for many git commands.
+    repos.add_arguments(run_parser, jobs_flags=('--repos-jobs',))
 
     # Index the arguments, so that we can process the leftover arguments in order.
     original_argv = sys.argv
@@ -49,12 +152,13 @@ def parse_args() -> Tuple[argparse.Namespace, List[str]]:
         for index, item in enumerate(sys.argv)
     }
 
-    # Temporarily remove any help flags, so that they can be passed through
-    # (rather than being handled by this parser).
+    # Temporarily remove any help flags, so that they can be passed through to git
+    # (rather than being handled by this parser). Other modes handle their own.
+    is_passthrough = sys.argv[1:2] == ['run']
     help_flags_index = []
     new_argv = []
     for index, item in enumerate(sys.argv):
-        if item not in {'-h', '--help'} or index < 2:
+        if item not in {'-h', '--help'} or index < 2 or not is_passthrough:
             new_argv.append(item)
         else:
             help_flags_index.append(index)
@@ -148,5 +252,23 @@ def _get_binary_directory() -> str:
     return os.path.realpath(os.path.join(directory, '../../bin'))
 
 
+def _import_mode(mode: str) -> Optional[ModuleType]:
+    """
+    Modes are only imported when they are run, since this is on the critical path for every
+    shimmed git command (and the fsmonitor hook).
+
+    :returns: the module for this mode, if it is the one being run.
+    """
+    if sys.argv[1:2] != [mode]:
+        return None
+
+    return importlib.import_module(f'.{mode}', __package__)
+
+
+def _get_description(mode: str) -> Optional[str]:
+    module = _import_mode(mode)
+    return module.__doc__ if module else None
+
+
 if __name__ == '__main__':
     sys.exit(run())
@@ -0,0 +1,192 @@
+"""
+Executes many gitfu commands in a single process, so that interpreter startup is only
+paid once, and caches (e.g. the location of git, or listed refs) stay warm between them.
+
+Commands are read from stdin, one per line, either as a shell-style command line:
+
+    switch-git-branch feature
+    git check src/
+
+or as JSON (a list of arguments, or an object with "args", and an optional "id"):
+
+    {"id": "step-1", "args": ["git", "status", "--short"]}
+
+For each command, a JSON result is written to stdout (including time spent waiting
+on the index lock).
+"""
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+import traceback
+from contextlib import contextmanager
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import IO
+from typing import Iterator
+from typing import List
+from typing import Tuple
+
+from . import main as gitfu_main
+from .core import git
+from .core import output
+from .exceptions import GitfuException
+from .standalone import add_git_staged_files
+from .standalone import remove_git_branch
+from .standalone import switch_git_branch
+
+
+class InvalidCommandError(GitfuException):
+    pass
+
+
+COMMANDS: Dict[str, Callable[..., Any]] = {
+    'git': gitfu_main.main,
+    'add-git-staged-files': add_git_staged_files.main,
+    'remove-git-branch': remove_git_branch.main,
+    'switch-git-branch': switch_git_branch.main,
+}
+
+
+def run(fail_fast: bool = False) -> int:
+    """
+    :returns: 0 if all commands succeeded, 1 otherwise.
+    """
+    returncode = 0
+    with _detach_stdin() as stream:
+        for index, line in enumerate(stream):
+            if not line.strip() or line.startswith('#'):
+                continue
+
+            result = execute(line, index=index)
+            print(json.dumps(result), flush=True)
+
+            if result['returncode']:
+                returncode = 1
+                if fail_fast:
+                    break
+
+    return returncode
+
+
+def execute(line: str, index: int = 0) -> Dict[str, Any]:
+    identifier: Any = index
+    args: List[str] = []
+    lock_metrics = git.get_lock_metrics()
+    start = time.perf_counter()
+    captured = output.CapturedOutput()
+    try:
+        with output.capture() as captured:
+            try:
+                identifier, args = parse_line(line, default_id=index)
+                returncode = _execute(*args)
+            except subprocess.CalledProcessError as e:
+                print(e.stderr or e.stdout or str(e), file=sys.stderr)
+                returncode = e.returncode or 1
+            except GitfuException as e:
+                print(str(e), file=sys.stderr)
+                returncode = 1
+            except SystemExit as e:
+                # e.g. argparse errors.
+                returncode = e.code if isinstance(e.code, int) else 1
+            except Exception:
+                traceback.print_exc()
+                returncode = 1
+    except Exception:
+        # e.g. the output couldn't be collected. Every command still gets a result, so
+        # that the rest of the batch can continue.
+        captured.stderr += traceback.format_exc()
+        returncode = 1
+
+    return {
+        'id': identifier,
+        'args': args,
+        'returncode': returncode,
+        'stdout': captured.stdout,
+        'stderr': captured.stderr,
+        'duration': round(time.perf_counter() - start, 6),
+        'locks': {
+            key: round(value - lock_metrics[key], 6)
+            for key, value in git.get_lock_metrics().items()
+        },
+    }
+
+
+def parse_line(line: str, default_id: Any = None) -> Tuple[Any, List[str]]:
+    """
+    :raises: InvalidCommandError
+    """
+    line = line.strip()
+    identifier = default_id
+    if line[0] in '[{':
+        try:
+            value = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise InvalidCommandError(f'Invalid JSON: {e}')
+
+        if isinstance(value, dict):
+            identifier = value.get('id', default_id)
+            value = value.get('args')
+
+        if (
+            not isinstance(value, list)
+            or not all(isinstance(item, str) for item in value)
+        ):
+            raise InvalidCommandError('Expected a list of string arguments.')
+
+        args = value
+    else:
+        try:
+            args = shlex.split(line)
+        except ValueError as e:
+            raise InvalidCommandError(f'Invalid command line: {e}')
+
+    if not args:
+        raise InvalidCommandError('No command specified.')
+
+    return identifier, args
+
+
+def _execute(command: str, *args: str) -> int:
+    """
+    :raises: InvalidCommandError
+    """
+    if command == 'gitfu' and args and args[0] == 'run':
+        command, args = 'git', args[1:]
+
+    func = COMMANDS.get(command.replace('_', '-'))
+    if not func:
+        raise InvalidCommandError(
+            f'Unknown command: {command}. Expected one of: {", ".join(sorted(COMMANDS))}',
+        )
+
+    # Commands fall back to parsing `sys.argv`, when no arguments are supplied.
+    sys.argv = [command, *args]
+    return func(*args) or 0
+
+
+@contextmanager
+def _detach_stdin() -> Iterator[IO[str]]:
+    """
+    Commands should not be able to consume the batch input (e.g. through a prompt),
+    so stdin is swapped out with /dev/null while they run.
+
+    :returns: the original stdin, to read commands from.
+    """
+    original_stdin = sys.stdin
+    stream = os.fdopen(os.dup(0))
+
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    sys.stdin = open(os.devnull)
+    try:
+        yield stream
+    finally:
+        sys.stdin.close()
+        sys.stdin = original_stdin
+        os.dup2(stream.fileno(), 0)
+        stream.close()
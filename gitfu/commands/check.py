@@ -3,43 +3,184 @@ Performs git diff (to make sure you're checking in the right thing), then
 prompts to add to staged files.
 """
 import argparse
+import fnmatch
+import hashlib
 import os
-import platform
+import subprocess
 import textwrap
-from functools import lru_cache
+from contextlib import closing
+from enum import Enum
+from typing import Dict
+from typing import Iterable
 from typing import Iterator
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import TextIO
+from typing import Tuple
 
 from ..core import color
 from ..core import git
+from ..core import index
+from ..core import pager
+from ..core import storage
+from ..core import terminal
+
+
+# Review decisions are persisted here, so that an interrupted session can be resumed.
+SESSION_FILENAME = 'check-session.jsonl'
+
+# Files matching these patterns (or changing more lines than the threshold) are collapsed
+# into a summary, since they're rarely worth reading line-by-line. More patterns can be added
+# through `git config --add gitfu.check.collapse <pattern>`, and the threshold is configured
+# through `gitfu.check.collapseThreshold`.
+DEFAULT_COLLAPSE_PATTERNS = (
+    '*.lock',
+    '*.min.css',
+    '*.min.js',
+    '*.map',
+    '*.pb.go',
+    '*_pb2.py',
+    '*.snap',
+    'go.sum',
+    'package-lock.json',
+    'pnpm-lock.yaml',
+)
+DEFAULT_COLLAPSE_THRESHOLD = 2000
+
+# Lines of deleted files longer than this (in bytes) are wrapped onto several lines.
+MAX_LINE_LENGTH = 4096
+
+PROMPT_HELP = {
+    'y': 'add this file',
+    'n': 'do not add this file',
+    's': 'skip this file for now (it will be shown again next time)',
+    'b': 'go back to the previous file',
+    'q': 'quit (progress is saved, and resumed next time)',
+    'e': 'expand this file',
+    '?': 'print help',
+}
+
+
+class Decision(Enum):
+    ADD = 'y'
+    IGNORE = 'n'
+    SKIP = 's'
+    BACK = 'b'
+    QUIT = 'q'
 
 
 def run(*argv: str) -> None:
     args = parse_args(*argv)
     filenames = args.filename
 
-    deleted_files = set(
-        git.run(
-            'diff', '--name-only', '--diff-filter=D',
-            colorize=False,
-        ).splitlines(),
-    )
-
+    session_path = storage.get_path(SESSION_FILENAME)
+    if args.reset:
+        storage.delete(session_path)
+
+    reviewed_files = load_session(session_path)
+
+    # Filenames are relative to the current directory, but sessions are per repository.
+    toplevel_directory = git.run('rev-parse', '--show-toplevel', colorize=False)
+
+    changes: Iterable[ChangedFile] = hydrate_filenames(*filenames)
+    if not args.no_triage:
+        changes = triage(
+            changes,
+            get_change_stats(*filenames),
+            patterns=get_collapse_patterns(),
+            threshold=(
+                args.collapse_threshold
+                if args.collapse_threshold is not None
+                else get_collapse_threshold()
+            ),
+            sort_by_size=args.sort_by_size,
+        )
+
+    # Previously reviewed files (and their index entries before they were added, if they
+    # were), for going back.
+    history: List[Tuple[ChangedFile, Optional[str]]] = []
+    revisits: List[ChangedFile] = []
+    remaining = iter(changes)
     try:
-        is_first_file = True
-        for filename in hydrate_filenames(*filenames):
-            if not is_first_file:
-                _clear_screen()
-
-            if filename in deleted_files:
-                verify_deletion(filename)
-            else:
-                check_and_prompt(filename)
-
-            is_first_file = False
-
-    except KeyboardInterrupt:
+        # Answers are read as single keypresses, and can be typed ahead.
+        with terminal.cbreak():
+            is_first_file = True
+            while True:
+                change = revisits.pop() if revisits else next(remaining, None)
+                if change is None:
+                    break
+
+                filename = change.filename
+                is_deleted = change.status == 'D'
+                session_key = os.path.relpath(os.path.abspath(filename), toplevel_directory)
+                content_hash = _get_content_hash(filename, is_deleted=is_deleted)
+                if content_hash and reviewed_files.get(session_key) == content_hash:
+                    continue
+
+                if not is_first_file:
+                    terminal.clear_screen()
+
+                is_first_file = False
+                if change.collapse_reason:
+                    decision = review_collapsed_file(change)
+                elif is_deleted:
+                    decision = verify_deletion(filename, stat=change.stat)
+                else:
+                    decision = check_and_prompt(filename)
+
+                if decision == Decision.QUIT:
+                    return
+
+                if decision == Decision.BACK:
+                    revisits.append(change)
+                    if history:
+                        previous, previous_entries = history.pop()
+                        previous_key = os.path.relpath(
+                            os.path.abspath(previous.filename),
+                            toplevel_directory,
+                        )
+                        if previous_entries is not None:
+                            _restore_index_entries(previous_key, previous_entries)
+
+                        revisits.append(previous)
+                        storage.append_journal(
+                            session_path,
+                            {
+                                'filename': previous_key,
+                                'hash': '',
+                                'added': False,
+                            },
+                        )
+
+                    continue
+
+                is_added = decision == Decision.ADD
+                entries = None
+                if is_added:
+                    entries = _get_index_entries(filename)
+                    git.run('add', filename)
+
+                if decision != Decision.SKIP:
+                    storage.append_journal(
+                        session_path,
+                        {
+                            'filename': session_key,
+                            'hash': content_hash,
+                            'added': is_added,
+                        },
+                    )
+
+                history.append((change, entries))
+
+    except (KeyboardInterrupt, EOFError):
         return
 
+    # Only interrupted sessions need to be resumed. However, runs scoped to specific files
+    # (or a subdirectory) don't cover everything that the session may have recorded.
+    if not filenames and not git.run('rev-parse', '--show-prefix', colorize=False):
+        storage.delete(session_path)
+
 
 def parse_args(*argv: str) -> argparse.Namespace:
     parser = argparse.ArgumentParser(
@@ -51,79 +192,394 @@ def parse_args(*argv: str) -> argparse.Namespace:
         nargs='*',
         help='Filename to examine.',
     )
+    parser.add_argument(
+        '--reset',
+        action='store_true',
+        help='Discards the progress saved from a previously interrupted session.',
+    )
+    parser.add_argument(
+        '--sort-by-size',
+        action='store_true',
+        help='Reviews files with the fewest changed lines first.',
+    )
+    parser.add_argument(
+        '--collapse-threshold',
+        type=int,
+        metavar='LINES',
+        help=(
+            'Collapses files which change more lines than this into a summary. '
+            f'Use 0 to disable. Defaults to {DEFAULT_COLLAPSE_THRESHOLD}.'
+        ),
+    )
+    parser.add_argument(
+        '--no-triage',
+        action='store_true',
+        help=(
+            'Reviews every file in full, in the order that git reports them '
+            '(skipping the size pre-pass).'
+        ),
+    )
 
     # NOTE: `None` is needed to print the help string.
     return parser.parse_args(argv or None)
 
 
-def hydrate_filenames(*filenames: str) -> Iterator[str]:
+class ChangeStat(NamedTuple):
+    # These are None for binary files.
+    added: Optional[int]
+    deleted: Optional[int]
+
+    @property
+    def is_binary(self) -> bool:
+        return self.added is None
+
+    @property
+    def size(self) -> int:
+        return (self.added or 0) + (self.deleted or 0)
+
+
+class ChangedFile(NamedTuple):
+    filename: str
+
+    # As reported by `git diff --name-status` (e.g. "M", or "D"). Empty if unknown.
+    status: str
+
+    stat: Optional[ChangeStat] = None
+
+    # If set, the file is summarized rather than displayed in full.
+    collapse_reason: str = ''
+
+
+def hydrate_filenames(*filenames: str) -> Iterator[ChangedFile]:
     """
-    Turns directories into actual paths.
+    Turns directories (and globs) into actual paths.
+
+    These are passed to git as pathspecs, so that only matching changes are listed
+    (rather than listing every changed file in the repository, and filtering them).
     """
-    known_files = git.run('diff', '--name-only', '--relative', colorize=False).splitlines()
+    unmatched_filenames = {os.path.normpath(filename): filename for filename in filenames}
+    records = git.stream(
+        'diff', '--name-status', '--relative', '-z', '--', *filenames,
+        delimiter=b'\0',
+    )
+    for status in records:
+        filename = next(records)
+        if status[0] in 'RC':
+            # Renames and copies report both the source, and the destination.
+            filename = next(records)
 
-    if not filenames:
-        yield from known_files
-        return
+        unmatched_filenames.pop(filename, None)
+        yield ChangedFile(filename, status[0])
+
+    # Explicitly requested files that git doesn't know about (e.g. untracked files)
+    # can still be reviewed.
+    for filename in unmatched_filenames.values():
+        if os.path.isfile(filename):
+            yield ChangedFile(filename, '')
 
-    for filename in filenames:
-        if os.path.isdir(filename):
-            yield from [
-                name
-                for name in known_files
-                if name.startswith(filename)
-            ]
+
+def get_change_stats(*filenames: str) -> Dict[str, ChangeStat]:
+    """
+    :returns: number of changed lines, for each file (through `git diff --numstat`).
+    """
+    output = {}
+    records = git.stream(
+        'diff', '--numstat', '--relative', '-z', '--', *filenames,
+        delimiter=b'\0',
+    )
+    for record in records:
+        added, deleted, filename = record.split('\t', 2)
+        if not filename:
+            # Renames and copies are followed by both the source, and the destination.
+            next(records)
+            filename = next(records)
+
+        output[filename] = ChangeStat(
+            added=int(added) if added != '-' else None,
+            deleted=int(deleted) if deleted != '-' else None,
+        )
+
+    return output
+
+
+def triage(
+    changes: Iterable[ChangedFile],
+    stats: Dict[str, ChangeStat],
+    patterns: Iterable[str] = DEFAULT_COLLAPSE_PATTERNS,
+    threshold: int = DEFAULT_COLLAPSE_THRESHOLD,
+    sort_by_size: bool = False,
+) -> List[ChangedFile]:
+    """
+    Groups files so that collapsed files (binaries, generated files, and very large
+    changes) are reviewed after everything else.
+    """
+    patterns = list(patterns)
+    expanded_files = []
+    collapsed_files = []
+    for change in changes:
+        stat = stats.get(change.filename)
+        change = change._replace(
+            stat=stat,
+            collapse_reason=_get_collapse_reason(change.filename, stat, patterns, threshold),
+        )
+        if change.collapse_reason:
+            collapsed_files.append(change)
         else:
-            yield filename
+            expanded_files.append(change)
+
+    if sort_by_size:
+        expanded_files.sort(key=lambda change: change.stat.size if change.stat else 0)
+        collapsed_files.sort(key=lambda change: change.stat.size if change.stat else 0)
+
+    return [*expanded_files, *collapsed_files]
+
+
+def get_collapse_patterns() -> List[str]:
+    """
+    :returns: the default patterns, along with any configured ones.
+    """
+    try:
+        patterns = git.run(
+            'config', '--get-all', 'gitfu.check.collapse',
+            colorize=False,
+        ).splitlines()
+    except subprocess.CalledProcessError:
+        # Not configured.
+        patterns = []
+
+    return [*DEFAULT_COLLAPSE_PATTERNS, *patterns]
+
+
+def get_collapse_threshold() -> int:
+    try:
+        return int(
+            git.run(
+                'config', '--get', '--type=int', 'gitfu.check.collapseThreshold',
+                colorize=False,
+            ),
+        )
+    except subprocess.CalledProcessError:
+        # Not configured.
+        return DEFAULT_COLLAPSE_THRESHOLD
+
+
+def _get_collapse_reason(
+    filename: str,
+    stat: Optional[ChangeStat],
+    patterns: List[str],
+    threshold: int,
+) -> str:
+    if not stat:
+        # e.g. untracked files.
+        return ''
+
+    if stat.is_binary:
+        return 'binary file'
+
+    for pattern in patterns:
+        if (
+            fnmatch.fnmatch(filename, pattern)
+            or fnmatch.fnmatch(os.path.basename(filename), pattern)
+        ):
+            return f'matches {pattern}'
+
+    if threshold and stat.size > threshold:
+        return f'more than {threshold} lines changed'
+
+    return ''
+
+
+def load_session(path: str) -> Dict[str, str]:
+    """
+    :returns: mapping of reviewed filenames to the content hash that was reviewed.
+    """
+    return {
+        entry['filename']: entry['hash']
+        for entry in storage.read_journal(path)
+    }
 
 
-def check_and_prompt(filename: str) -> None:
+def check_and_prompt(filename: str) -> Decision:
     git.run('diff', filename, capture_output=False)
     print()
 
-    if should_add_file():
-        git.run('add', filename)
+    return ask_to_add()
 
 
-def verify_deletion(filename: str) -> None:
-    # Custom output of deleted files.
-    lines = [
-        color.colorize(f'-{line}', color.AnsiColor.RED)
-        for line in git.run('show', f'HEAD:{filename}', colorize=False).splitlines()
-    ]
+def review_collapsed_file(change: ChangedFile) -> Decision:
+    """
+    Shows a summary of the change, with the option to expand it.
+    """
+    summary = change.filename
+    if change.status == 'D':
+        summary += ' (deleted)'
+
+    if change.stat and not change.stat.is_binary:
+        summary += f', +{change.stat.added} -{change.stat.deleted}'
+
+    reason = color.colorize(f'collapsed: {change.collapse_reason}', color.AnsiColor.YELLOW)
+    print(f'{summary} [{reason}]')
+    print()
+
+    value = _prompt('Do you want to add this file?', options='ynsbqe')
+    if value == 'e':
+        print()
+        if change.status == 'D':
+            return verify_deletion(change.filename, stat=change.stat)
+
+        return check_and_prompt(change.filename)
+
+    return Decision(value)
 
+
+def verify_deletion(filename: str, stat: Optional[ChangeStat] = None) -> Decision:
+    """
+    The deleted file is streamed through the pager in chunks, so that memory usage stays
+    bounded (and output starts immediately), regardless of the size of the file. Very long
+    lines (e.g. in minified files) are wrapped.
+    """
+    if not stat:
+        stat = get_change_stats(filename).get(filename, ChangeStat(None, None))
+
+    # Custom output of deleted files.
     header = textwrap.dedent(f"""
         diff --git a/{filename} b/{filename}
         index {_get_current_sha()[:7]}..0000000
-        --- a/{filename}
-        +++ /dev/null
-        @@ -0,0 +1,{len(lines)} @@
     """)[1:-1]
 
-    print(header)
-    print('\n'.join(lines))
-    print()
+    try:
+        with pager.open_pager() as f:
+            # NOTE: `./` is needed, since filenames are relative to the current directory.
+            if stat.is_binary:
+                size = git.run('cat-file', '-s', f'HEAD:./{filename}', colorize=False)
+                f.write(f'{header}\nBinary file a/{filename} ({size} bytes) deleted\n\n')
+            else:
+                f.write(
+                    f'{header}\n--- a/{filename}\n+++ /dev/null\n'
+                    f'@@ -1,{stat.deleted} +0,0 @@\n',
+                )
+                with closing(
+                    git.stream(
+                        'cat-file', 'blob', f'HEAD:./{filename}',
+                        max_length=MAX_LINE_LENGTH,
+                    ),
+                ) as lines:
+                    _write_in_chunks(
+                        f,
+                        (
+                            color.colorize(f'-{line}', color.AnsiColor.RED) + '\n'
+                            for line in lines
+                        ),
+                    )
+
+                f.write('\n')
+    except BrokenPipeError:
+        # The user quit the pager early.
+        pass
+
+    return ask_to_add()
+
+
+def _write_in_chunks(f: TextIO, lines: Iterable[str], chunk_size: int = 1024) -> None:
+    """
+    Batches writes, since writing line-by-line to a pipe is slow.
+    """
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= chunk_size:
+            f.write(''.join(chunk))
+            chunk = []
+
+    f.write(''.join(chunk))
+    f.flush()
 
-    if should_add_file():
-        git.run('add', filename)
+
+def _get_content_hash(filename: str, is_deleted: bool = False) -> str:
+    """
+    Computes the git blob id of the file in the worktree, without spawning `git hash-object`.
+    """
+    if is_deleted:
+        return 'deleted'
+
+    try:
+        if os.path.islink(filename):
+            content = os.readlink(filename).encode()
+            return hashlib.sha1(f'blob {len(content)}\0'.encode() + content).hexdigest()
+
+        digest = hashlib.sha1(f'blob {os.path.getsize(filename)}\0'.encode())
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+    except OSError:
+        # e.g. the file was removed since we listed it.
+        return ''
+
+    return digest.hexdigest()
+
+
+@git.cached
+def _get_index_entries(filename: str) -> str:
+    """
+    :returns: the file's entries in the index (in `update-index -z --index-info` format),
+        so that they can be restored later.
+    """
+    return git.run(
+        'ls-files', '--stage', '--full-name', '-z', '--', filename,
+        colorize=False,
+    ) or ''
+
+
+def _restore_index_entries(path: str, entries: str) -> None:
+    """
+    Unlike `git reset`, this keeps whatever was staged beforehand (e.g. partially staged
+    hunks, or merge conflicts).
+
+    :param path: relative to the repository root.
+    """
+    # The path is removed first, since higher stage entries (i.e. conflicts) can't be
+    # added alongside the entry that `git add` created. Untracked files aren't re-added.
+    removal = f'0 {"0" * index.get_hash_size() * 2}\t{path}\0'
+    git.run(
+        'update-index', '-z', '--index-info',
+        input=(removal + entries).encode(),
+    )
 
 
-@lru_cache(maxsize=1)
 def _get_current_sha() -> str:
     return git.run('rev-parse', 'HEAD', colorize=False)
 
 
-def should_add_file() -> bool:
-    value = input('Do you want to add this file? (y/n) ').lower()
-    while value not in 'yn':
-        value = input('Do you want to add this file? (y/n) ').lower()
+def ask_to_add() -> Decision:
+    return Decision(_prompt('Do you want to add this file?', options='ynsbq'))
+
+
+def _prompt(question: str, options: str) -> str:
+    """
+    Answers are single keypresses (without needing Enter), when attached to a terminal.
+
+    :raises: EOFError
+    """
+    question = f'{question} [{",".join(options)},?] '
+    while True:
+        if terminal.is_interactive():
+            print(question, end='', flush=True)
+            value = terminal.read_key().lower()
+            while value not in [*options, '?']:
+                value = terminal.read_key().lower()
+
+            print(value)
+        else:
+            value = input(question).lower()
 
-    return value == 'y'
+        if value == '?':
+            for option in [*options, '?']:
+                print(f'{option} - {PROMPT_HELP[option]}')
 
+            continue
 
-def _clear_screen() -> None:
-    command = 'cls' if platform.system() == 'Windows' else 'clear'
-    os.system(command)
+        if value in list(options):
+            return value
 
 
 if __name__ == '__main__':
@@ -1,10 +1,50 @@
+import os
+import shutil
 import subprocess
+from contextlib import contextmanager
+from typing import Iterator
+from typing import List
+from typing import NamedTuple
+from typing import Sequence
 
+from ..core import checks
 from ..core import color
 from ..core import git
+from ..core import index
+from ..core import storage
 from ..exceptions import GitfuException
 
 
+# Used to check what `git commit -a` (or `git commit <paths>`) would commit, without
+# touching the real index.
+TEMPORARY_INDEX_FILENAME = 'commit-checks.index'
+
+# `git commit` options that take a value, so that it isn't mistaken for a pathspec.
+VALUE_OPTIONS = {
+    '-m', '-F', '-C', '-c', '-t',
+    '--message', '--file', '--reuse-message', '--reedit-message', '--template',
+    '--author', '--date', '--cleanup', '--fixup', '--squash', '--trailer',
+}
+
+# These stage changes after our checks would have run.
+UNSUPPORTED_OPTIONS = {
+    '--interactive', '-p', '--patch', '--pathspec-from-file',
+}
+
+
+class CommitArgs(NamedTuple):
+    # i.e. `git commit -a`
+    is_all: bool
+
+    # i.e. `git commit <paths>` (as opposed to `git commit --include <paths>`)
+    is_only: bool
+    pathspecs: List[str]
+    no_verify: bool
+
+    # Set if the commit stages changes that checks can't see beforehand (e.g. `--patch`).
+    unsupported_option: str = ''
+
+
 def run(*argv: str) -> None:
     try:
         prevent_wip_commits()
@@ -12,6 +52,13 @@ def run(*argv: str) -> None:
         if '--amend' not in argv:
             raise
 
+    args = _parse_commit_args(argv)
+    if not args.no_verify:
+        configured_checks = checks.get_checks()
+        if configured_checks:
+            with _get_commit_index(args):
+                run_checks(configured_checks, amend='--amend' in argv)
+
     git.run('commit', *argv, capture_output=False)
 
 
@@ -36,5 +83,167 @@ def prevent_wip_commits():
         )
 
 
+def run_checks(configured_checks: List[checks.Check], amend: bool = False) -> None:
+    """
+    Runs the configured per-file checks (see `core.checks`) over the staged files.
+
+    :raises: CheckFailedException
+    """
+    # When amending, the commit also includes the files from the previous commit.
+    # These will mostly be cached though.
+    results = checks.run_checks(
+        configured_checks,
+        checks.get_staged_files(base='HEAD~1' if amend else 'HEAD'),
+    )
+    print(checks.summarize(results))
+
+    failures = [result for result in results if not result.passed]
+    if failures:
+        raise CheckFailedException(
+            '\n'.join([
+                f'{color.colorize("ERROR:", color.AnsiColor.RED)} '
+                f'{len(failures)} check{"s" if len(failures) > 1 else ""} failed.',
+                *[
+                    f'\n[{result.check}] {result.filename}\n{result.output}'.rstrip()
+                    for result in failures
+                ],
+            ]),
+        )
+
+
+@contextmanager
+def _get_commit_index(args: CommitArgs) -> Iterator[None]:
+    """
+    Points git at an index with the content that will actually be committed (while active),
+    for commits that don't just commit the staged changes.
+
+    :raises: CheckFailedException
+    :raises: subprocess.CalledProcessError
+    """
+    if args.unsupported_option:
+        raise _get_unsupported_option_error(args.unsupported_option)
+
+    if not args.is_all and not args.pathspecs:
+        yield
+        return
+
+    path = storage.get_path(TEMPORARY_INDEX_FILENAME)
+    if args.is_only:
+        # Includes files that are staged, but not yet in HEAD (which `add -u` would skip).
+        # NOTE: This needs to be listed from the real index.
+        filenames = list(
+            git.stream('ls-files', '-z', '--', *args.pathspecs, delimiter=b'\0'),
+        )
+    else:
+        try:
+            shutil.copyfile(index.get_index_path(), path)
+        except FileNotFoundError:
+            # Nothing staged yet.
+            storage.delete(path)
+
+    original_index = os.environ.get('GIT_INDEX_FILE')
+    os.environ['GIT_INDEX_FILE'] = path
+    try:
+        if args.is_only:
+            # Only the specified paths are committed (on top of HEAD).
+            try:
+                git.run('read-tree', 'HEAD')
+            except subprocess.CalledProcessError:
+                # No commits yet.
+                git.run('read-tree', '--empty')
+
+            if filenames:
+                git.run(
+                    'update-index', '--add', '--remove', '-z', '--stdin',
+                    input=b''.join(os.fsencode(filename) + b'\0' for filename in filenames),
+                )
+        else:
+            git.run('add', '-u', '--', *args.pathspecs)
+
+        yield
+    finally:
+        if original_index is None:
+            del os.environ['GIT_INDEX_FILE']
+        else:
+            os.environ['GIT_INDEX_FILE'] = original_index
+
+        storage.delete(path)
+
+
+def _parse_commit_args(argv: Sequence[str]) -> CommitArgs:
+    is_all = False
+    is_include = False
+    no_verify = False
+    unsupported_option = ''
+    pathspecs: List[str] = []
+
+    args = iter(argv)
+    for arg in args:
+        if arg == '--':
+            pathspecs.extend(args)
+            break
+
+        name = arg.split('=', 1)[0]
+        if name in UNSUPPORTED_OPTIONS:
+            unsupported_option = '--patch' if name == '-p' else name
+            continue
+
+        if arg.startswith('--'):
+            if arg == '--all':
+                is_all = True
+            elif arg == '--include':
+                is_include = True
+            elif arg in {'--no-verify', '--verify'}:
+                no_verify = arg == '--no-verify'
+            elif name in VALUE_OPTIONS and '=' not in arg:
+                next(args, None)
+
+            continue
+
+        if arg.startswith('-') and arg != '-':
+            # Short options can be combined (e.g. `-am <message>`, or `-nm <message>`).
+            for position, flag in enumerate(arg[1:], start=1):
+                if flag == 'a':
+                    is_all = True
+                elif flag == 'i':
+                    is_include = True
+                elif flag == 'n':
+                    no_verify = True
+                elif flag == 'p':
+                    unsupported_option = '--patch'
+                elif f'-{flag}' in VALUE_OPTIONS:
+                    if position == len(arg) - 1:
+                        next(args, None)
+
+                    break
+                elif flag in 'uS':
+                    # These take optional values, which can only be attached.
+                    break
+
+            continue
+
+        pathspecs.append(arg)
+
+    return CommitArgs(
+        is_all=is_all,
+        is_only=bool(pathspecs) and not is_include,
+        pathspecs=pathspecs,
+        no_verify=no_verify,
+        unsupported_option=unsupported_option,
+    )
+
+
+def _get_unsupported_option_error(option: str) -> 'CheckFailedException':
+    return CheckFailedException(
+        f'{color.colorize("ERROR:", color.AnsiColor.RED)} '
+        f'Checks can\'t be run with `{option}`. Stage your changes first, '
+        'or use --no-verify.',
+    )
+
+
 class LastCommitWIPException(GitfuException):
     pass
+
+
+class CheckFailedException(GitfuException):
+    pass
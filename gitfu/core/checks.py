@@ -0,0 +1,324 @@
+"""
+Runs per-file checks over staged blobs (e.g. linters, or secret scanners), in parallel.
+
+Passing results are cached by (check version, blob id), so unchanged files are never
+re-checked.
+Checks are configured through git config, e.g.
+
+    $ git config gitfu-check.flake8.command 'flake8 --stdin-display-name="$GITFU_FILENAME" -'
+    $ git config gitfu-check.flake8.pattern '*.py'
+    $ git config gitfu-check.conflicts.builtin merge-conflict
+
+Commands receive the staged content on stdin (and the filename in $GITFU_FILENAME), and
+fail the check with a non-zero exit code.
+"""
+import fnmatch
+import hashlib
+import os
+import re
+import subprocess
+import time
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+from . import git
+from . import storage
+from ..exceptions import GitfuException
+
+
+CACHE_FILENAME = 'commit-checks.jsonl'
+CONFIG_SECTION = 'gitfu-check'
+
+# Used to diff against, when there are no commits yet.
+EMPTY_TREE = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+
+MERGE_CONFLICT_REGEX = re.compile(rb'^(<<<<<<< |=======$|>>>>>>> )', re.MULTILINE)
+PRIVATE_KEY_REGEX = re.compile(rb'-----BEGIN [A-Z ]*PRIVATE KEY-----')
+
+
+class InvalidCheckError(GitfuException):
+    pass
+
+
+class Check(NamedTuple):
+    name: str
+    command: str = ''
+    builtin: str = ''
+    patterns: Tuple[str, ...] = ()
+
+    # Changing this invalidates cached results. Defaults to a hash of the check itself.
+    version: str = ''
+
+    def get_version(self) -> str:
+        return self.version or hashlib.sha1(
+            f'{self.command}\0{self.builtin}'.encode(),
+        ).hexdigest()[:12]
+
+    def matches(self, filename: str) -> bool:
+        return not self.patterns or any(
+            fnmatch.fnmatch(filename, pattern)
+            or fnmatch.fnmatch(os.path.basename(filename), pattern)
+            for pattern in self.patterns
+        )
+
+
+class StagedFile(NamedTuple):
+    filename: str
+    blob: str
+
+
+class CheckResult(NamedTuple):
+    check: str
+    filename: str
+    blob: str
+    passed: bool
+    output: str = ''
+    duration: float = 0.0
+    is_cached: bool = False
+
+
+def get_checks() -> List[Check]:
+    """
+    :raises: InvalidCheckError
+    """
+    try:
+        lines = git.run(
+            'config', '--get-regexp', rf'^{CONFIG_SECTION}\.',
+            colorize=False,
+        ).splitlines()
+    except subprocess.CalledProcessError:
+        # Nothing configured.
+        return []
+
+    values: Dict[str, Dict[str, List[str]]] = {}
+    for line in lines:
+        key, _, value = line.partition(' ')
+        name, _, attribute = key[len(CONFIG_SECTION) + 1:].rpartition('.')
+        values.setdefault(name, {}).setdefault(attribute, []).append(value)
+
+    checks = []
+    for name, attributes in values.items():
+        check = Check(
+            name=name,
+            command=attributes.get('command', [''])[-1],
+            builtin=attributes.get('builtin', [''])[-1],
+            patterns=tuple(attributes.get('pattern', [])),
+            version=attributes.get('version', [''])[-1],
+        )
+        if check.builtin and check.builtin not in BUILTIN_CHECKS:
+            raise InvalidCheckError(
+                f'Unknown builtin for {CONFIG_SECTION}.{name}: {check.builtin}. '
+                f'Expected one of: {", ".join(BUILTIN_CHECKS)}',
+            )
+
+        if not check.command and not check.builtin:
+            raise InvalidCheckError(
+                f'{CONFIG_SECTION}.{name} needs either a `command` or a `builtin`.',
+            )
+
+        checks.append(check)
+
+    return checks
+
+
+def get_staged_files(base: str = 'HEAD') -> List[StagedFile]:
+    """
+    :returns: files (and their blob ids) that would be part of the commit.
+    """
+    try:
+        git.run('rev-parse', '--verify', '--quiet', base, colorize=False)
+    except subprocess.CalledProcessError:
+        base = EMPTY_TREE
+
+    # e.g. :100644 100644 <src blob> <dst blob> M\0<filename>\0
+    records = git.stream(
+        'diff-index', '--cached', '-z', '--diff-filter=ACMR', '--no-renames', base,
+        delimiter=b'\0',
+    )
+    output = []
+    for metadata in records:
+        filename = next(records)
+        _, mode, _, blob, _ = metadata.split(' ')
+        if mode.startswith('16') or mode.startswith('12'):
+            # Submodules, and symlinks.
+            continue
+
+        output.append(StagedFile(filename, blob))
+
+    return output
+
+
+def run_checks(
+    checks: List[Check],
+    files: List[StagedFile],
+    jobs: Optional[int] = None,
+) -> List[CheckResult]:
+    cache_path = storage.get_path(CACHE_FILENAME)
+    cache = {
+        (entry['check'], entry['version'], entry['blob']): entry
+        for entry in storage.read_journal(cache_path)
+    }
+
+    results = []
+    pending: List[Tuple[Check, StagedFile]] = []
+    for check in checks:
+        version = check.get_version()
+        for file in files:
+            if not check.matches(file.filename):
+                continue
+
+            entry = cache.get((check.name, version, file.blob))
+            if entry:
+                results.append(
+                    CheckResult(
+                        check=check.name,
+                        filename=file.filename,
+                        blob=file.blob,
+                        passed=entry['passed'],
+                        output=entry['output'],
+                        is_cached=True,
+                    ),
+                )
+            else:
+                pending.append((check, file))
+
+    if not pending:
+        return results
+
+    contents = dict(read_blobs({file.blob for _, file in pending}))
+
+    # NOTE: This is imported here, since it takes a while (and most runs don't need it).
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(_run_check, check, file, contents[file.blob])
+            for check, file in pending
+        ]
+        for (check, _), future in zip(pending, futures):
+            result = future.result()
+            results.append(result)
+            if not result.passed:
+                # Failures aren't cached, since they may be environmental (e.g. the
+                # linter isn't installed), rather than caused by the content.
+                continue
+
+            storage.append_journal(
+                cache_path,
+                {
+                    'check': result.check,
+                    'version': check.get_version(),
+                    'blob': result.blob,
+                    'passed': result.passed,
+                    'output': result.output,
+                },
+            )
+
+    return results
+
+
+def read_blobs(blobs: Iterable[str]) -> Iterator[Tuple[str, bytes]]:
+    """
+    Reads all blobs through a single `git cat-file --batch` process, rather than
+    spawning a process per file.
+    """
+    process = git.popen('cat-file', '--batch', stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    try:
+        for blob in blobs:
+            process.stdin.write(f'{blob}\n'.encode())  # type: ignore
+            process.stdin.flush()  # type: ignore
+
+            # e.g. <blob> blob <size>\n<content>\n
+            header = process.stdout.readline().decode().split()  # type: ignore
+            if len(header) != 3:
+                # e.g. <blob> missing
+                yield blob, b''
+                continue
+
+            content = process.stdout.read(int(header[2]))  # type: ignore
+            process.stdout.read(1)  # type: ignore
+            yield blob, content
+    finally:
+        process.stdin.close()  # type: ignore
+        process.wait()
+        process.stdout.close()  # type: ignore
+
+
+def summarize(results: List[CheckResult]) -> str:
+    """
+    :returns: per-check timing summary.
+    """
+    summary: Dict[str, Dict[str, float]] = {}
+    for result in results:
+        stats = summary.setdefault(
+            result.check,
+            {'files': 0, 'cached': 0, 'failed': 0, 'duration': 0.0},
+        )
+        stats['files'] += 1
+        stats['cached'] += result.is_cached
+        stats['failed'] += not result.passed
+        stats['duration'] += result.duration
+
+    return '\n'.join(
+        f'{name:<20} {int(stats["files"])} files ({int(stats["cached"])} cached, '
+        f'{int(stats["failed"])} failed) in {stats["duration"]:.2f}s'
+        for name, stats in summary.items()
+    )
+
+
+def _run_check(check: Check, file: StagedFile, content: bytes) -> CheckResult:
+    start = time.perf_counter()
+    if check.builtin:
+        output = BUILTIN_CHECKS[check.builtin](file.filename, content)
+        passed = not output
+    else:
+        process = subprocess.run(
+            check.command,
+            shell=True,
+            input=content,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env={**os.environ, 'GITFU_FILENAME': file.filename},
+        )
+        output = process.stdout.decode(errors='replace').rstrip()
+        passed = process.returncode == 0
+
+    return CheckResult(
+        check=check.name,
+        filename=file.filename,
+        blob=file.blob,
+        passed=passed,
+        output=output,
+        duration=time.perf_counter() - start,
+    )
+
+
+def _check_merge_conflict(filename: str, content: bytes) -> str:
+    match = MERGE_CONFLICT_REGEX.search(content)
+    if not match:
+        return ''
+
+    line_number = content.count(b'\n', 0, match.start()) + 1
+    return f'{filename}:{line_number}: merge conflict marker'
+
+
+def _check_private_key(filename: str, content: bytes) -> str:
+    match = PRIVATE_KEY_REGEX.search(content)
+    if not match:
+        return ''
+
+    line_number = content.count(b'\n', 0, match.start()) + 1
+    return f'{filename}:{line_number}: private key'
+
+
+# These return an error message (or an empty string, if the check passed).
+BUILTIN_CHECKS: Dict[str, Callable[[str, bytes], str]] = {
+    'merge-conflict': _check_merge_conflict,
+    'private-key': _check_private_key,
+}
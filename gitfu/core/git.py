@@ -1,19 +1,110 @@
 import os
+import random
+import re
 import subprocess
 import sys
+import tempfile
+import time
+from contextlib import contextmanager
 from functools import lru_cache
+from functools import wraps
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
 from typing import Optional
+from typing import Tuple
 
 
-def run(*args: str, colorize: bool = True, capture_output: bool = True) -> Optional[str]:
+# When set, all git commands are run against this repository (through `git -C`).
+_target_directory: Optional[str] = None
+
+# Git commands that never modify refs, or the index.
+READ_ONLY_COMMANDS = {
+    'blame', 'cat-file', 'diff', 'grep', 'log', 'ls-files', 'ls-tree', 'rev-list',
+    'rev-parse', 'shortlog', 'show', 'show-ref', 'var',
+}
+
+# Flags that make `git branch` modify refs, rather than listing them.
+MUTATING_BRANCH_FLAGS = {
+    '-c', '-C', '-d', '-D', '-f', '-m', '-M', '-u',
+    '--copy', '--delete', '--force', '--move', '--set-upstream-to', '--unset-upstream',
+}
+
+# Git commands that only mutate the repository through these subcommands.
+MUTATING_SUBCOMMANDS = {
+    'sparse-checkout': {'add', 'disable', 'init', 'reapply', 'set'},
+}
+
+# Git commands that write to the index, and are safe to retry when they fail to take
+# `index.lock` (since git takes it before changing anything). Multi-step commands (e.g.
+# `stash`, `pull`, `rebase`) may fail on the lock partway through, so aren't retried.
+RETRYABLE_INDEX_COMMANDS = {
+    'add', 'checkout', 'read-tree', 'reset', 'restore', 'rm', 'switch', 'update-index',
+}
+
+# e.g. fatal: Unable to create '/path/to/repo/.git/index.lock': File exists.
+LOCK_CONTENTION_REGEX = re.compile(r"Unable to create '[^']+\.lock': File exists")
+
+# How long to keep retrying when the index is locked by someone else (in seconds).
+# This can be overridden with $GITFU_LOCK_TIMEOUT.
+DEFAULT_LOCK_TIMEOUT = 10.0
+INITIAL_BACKOFF = 0.05
+MAX_BACKOFF = 1.0
+
+_caches: List[Any] = []
+
+try:
+    import fcntl
+except ImportError:     # pragma: no cover
+    # e.g. Windows. We'll still retry on contention, but can't serialize our own mutators.
+    fcntl = None        # type: ignore
+
+
+class LockMetrics:
+    """
+    Tracks how much time is spent waiting on locks, so that contention with other
+    tools can be diagnosed (see `get_lock_metrics`).
+    """
+
+    def __init__(self) -> None:
+        self.operations = 0
+        self.retries = 0
+        self.timeouts = 0
+
+        # In seconds.
+        self.advisory_lock_wait = 0.0
+        self.index_lock_wait = 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(vars(self))
+
+
+_lock_metrics = LockMetrics()
+
+
+def run(
+    *args: str,
+    colorize: bool = True,
+    capture_output: bool = True,
+    input: Optional[bytes] = None,
+) -> Optional[str]:
     """
     :param colorize: set to False if attempting to mutate original git output.
     :param capture_output: set to False if just relying on `git` to format output
         (e.g. git clone progress bar)
+    :param input: sent to git's stdin (e.g. for `--pathspec-from-file=-`).
 
     :raises: subprocess.CalledProcessError
     """
+    if is_mutating(*args):
+        invalidate_caches()
+
     params = [_get_path_to_original_git()]
+    if _target_directory:
+        params.extend(['-C', _target_directory])
+
     if colorize and sys.stdout.isatty():
         # Source: https://stackoverflow.com/a/22074539
         params.extend(['-c', 'color.ui=always'])
@@ -24,9 +115,49 @@ def run(*args: str, colorize: bool = True, capture_output: bool = True) -> Optio
     if capture_output:
         options['stderr'] = subprocess.PIPE
         options['stdout'] = subprocess.PIPE
+    if input is not None:
+        options['input'] = input
+
+    # NOTE: Only our own (captured) commands are serialized and retried. Passthrough
+    # commands may be interactive (e.g. `git commit` with an editor open), and holding the
+    # lock for them would block every other gitfu process in the meantime. Besides, we
+    # can only detect contention if we're able to read git's error message.
+    if not capture_output or not args or args[0] not in RETRYABLE_INDEX_COMMANDS:
+        return _execute([*params, *args], options, capture_output)
+
+    _lock_metrics.operations += 1
+    deadline = time.monotonic() + _get_lock_timeout()
+    with _advisory_lock(deadline):
+        backoff = INITIAL_BACKOFF
+        while True:
+            try:
+                return _execute([*params, *args], options, capture_output)
+            except subprocess.CalledProcessError as e:
+                if not (e.stderr and LOCK_CONTENTION_REGEX.search(e.stderr)):
+                    raise
+
+                delay = min(backoff, MAX_BACKOFF) * random.uniform(0.5, 1.5)
+                if time.monotonic() + delay > deadline:
+                    _lock_metrics.timeouts += 1
+                    raise
+
+                _trace(f'index is locked, retrying `git {args[0]}` in {delay:.3f}s')
+                _lock_metrics.retries += 1
+                _lock_metrics.index_lock_wait += delay
+                time.sleep(delay)
+                backoff *= 2
+
 
+def _execute(
+    params: List[str],
+    options: Dict[str, Any],
+    capture_output: bool,
+) -> Optional[str]:
+    """
+    :raises: subprocess.CalledProcessError
+    """
     try:
-        response = subprocess.run([*params, *args], **options)
+        response = subprocess.run(params, **options)
         if capture_output:
             return response.stdout.decode().rstrip()
     except subprocess.CalledProcessError as e:
@@ -37,6 +168,238 @@ def run(*args: str, colorize: bool = True, capture_output: bool = True) -> Optio
 
         raise e
 
+    return None
+
+
+def get_lock_metrics() -> Dict[str, Any]:
+    return _lock_metrics.as_dict()
+
+
+@contextmanager
+def _advisory_lock(deadline: float) -> Iterator[None]:
+    """
+    Serializes index mutations between gitfu processes (in the same repository), so that
+    they wait on each other, rather than fail on `index.lock`.
+
+    If the lock can't be acquired before the deadline, we proceed anyway (and rely on
+    retrying on git's own lock).
+    """
+    if not fcntl:
+        yield
+        return
+
+    try:
+        directory = os.path.join(get_git_directory(), 'gitfu')
+        os.makedirs(directory, exist_ok=True)
+        f = open(os.path.join(directory, 'mutation.lock'), 'w')
+    except (OSError, subprocess.CalledProcessError):
+        # e.g. not in a git repository. Let git report the error.
+        yield
+        return
+
+    with f:
+        start = time.monotonic()
+        backoff = INITIAL_BACKOFF
+        is_locked = False
+        while True:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                is_locked = True
+                break
+            except BlockingIOError:
+                delay = min(backoff, MAX_BACKOFF) * random.uniform(0.5, 1.5)
+                if time.monotonic() + delay > deadline:
+                    _trace('timed out waiting on other gitfu processes')
+                    break
+
+                time.sleep(delay)
+                backoff *= 2
+
+        _lock_metrics.advisory_lock_wait += time.monotonic() - start
+        try:
+            yield
+        finally:
+            if is_locked:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _get_lock_timeout() -> float:
+    try:
+        return float(os.environ['GITFU_LOCK_TIMEOUT'])
+    except (KeyError, ValueError):
+        return DEFAULT_LOCK_TIMEOUT
+
+
+def _trace(message: str) -> None:
+    # Similar to GIT_TRACE, for diagnosing lock contention.
+    if os.environ.get('GITFU_TRACE_LOCKS'):
+        print(f'gitfu: {message}', file=sys.stderr)
+
+
+def stream(
+    *args: str,
+    delimiter: bytes = b'\n',
+    max_length: Optional[int] = None,
+) -> Iterator[str]:
+    """
+    Lazily yields git's output one record at a time, so that very large outputs
+    (e.g. 100k changed files) do not need to be held in memory at once.
+
+    :param delimiter: use b'\0' with git's `-z` flag, for unambiguous filenames.
+    :param max_length: if specified, records longer than this (in bytes) are split into
+        several records, so that memory stays bounded (e.g. for minified files).
+    :raises: subprocess.CalledProcessError
+    """
+    # NOTE: stderr goes to a file, rather than a pipe, since git can write plenty to it
+    # while producing output (e.g. per-file warnings), and a full pipe would block it.
+    with tempfile.TemporaryFile() as stderr:
+        process = popen(*args, stdout=subprocess.PIPE, stderr=stderr)
+        try:
+            buffer = bytearray()
+            for chunk in iter(lambda: process.stdout.read1(64 * 1024), b''):  # type: ignore
+                # Only the new chunk needs to be searched, since the rest of the buffer
+                # has no delimiters.
+                start = max(len(buffer) - len(delimiter) + 1, 0)
+                buffer += chunk
+
+                end = buffer.rfind(delimiter, start)
+                if end != -1:
+                    for record in buffer[:end].split(delimiter):
+                        yield from _split_record(record, max_length)
+
+                    del buffer[:end + len(delimiter)]
+
+                if max_length and len(buffer) > max_length:
+                    # The rest of the record is still to come.
+                    length = len(buffer) - len(buffer) % max_length
+                    yield from _split_record(buffer[:length], max_length)
+                    del buffer[:length]
+
+            if buffer:
+                yield from _split_record(buffer, max_length)
+
+            if process.wait():
+                stderr.seek(0)
+                raise subprocess.CalledProcessError(
+                    process.returncode,
+                    process.args,
+                    stderr=stderr.read().decode(errors='replace').rstrip(),
+                )
+        finally:
+            if process.poll() is None:
+                # The consumer stopped early.
+                process.kill()
+                process.wait()
+
+            process.stdout.close()  # type: ignore
+
+
+def _split_record(record: bytes, max_length: Optional[int]) -> Iterator[str]:
+    if not max_length or len(record) <= max_length:
+        yield record.decode(errors='replace')
+        return
+
+    for start in range(0, len(record), max_length):
+        yield record[start:start + max_length].decode(errors='replace')
+
+
+def popen(*args: str, **options: Any) -> subprocess.Popen:
+    """
+    For long-running git processes that need to be interacted with (e.g. `cat-file --batch`).
+    """
+    if is_mutating(*args):
+        invalidate_caches()
+
+    params = [_get_path_to_original_git()]
+    if _target_directory:
+        params.extend(['-C', _target_directory])
+
+    return subprocess.Popen([*params, *args], **options)
+
+
+def is_mutating(*args: str) -> bool:
+    """
+    Conservatively determines whether this git command may modify refs, or the index.
+    """
+    if not args:
+        return False
+
+    command, *flags = args
+    if command in READ_ONLY_COMMANDS:
+        return False
+
+    if command in MUTATING_SUBCOMMANDS:
+        # e.g. `git sparse-checkout list` is read-only.
+        return bool(flags) and flags[0] in MUTATING_SUBCOMMANDS[command]
+
+    if command == 'branch':
+        # Listing branches only uses flags (e.g. `git branch -r --merged`).
+        return any(
+            not flag.startswith('-') or flag.split('=')[0] in MUTATING_BRANCH_FLAGS
+            for flag in flags
+        )
+
+    return True
+
+
+def cached(func: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    Caches the results of read-only git queries (per repository), until a git command
+    that may mutate refs or the index is run.
+    """
+    @lru_cache(maxsize=None)
+    def cached_func(repository: Tuple[Optional[str], str], *args: Any) -> Any:
+        return func(*args)
+
+    @wraps(func)
+    def wrapped(*args: Any) -> Any:
+        return cached_func((_target_directory, os.getcwd()), *args)
+
+    wrapped.cache_clear = cached_func.cache_clear  # type: ignore
+    _caches.append(wrapped)
+    return wrapped
+
+
+def invalidate_caches() -> None:
+    for func in _caches:
+        func.cache_clear()
+
+
+@cached
+def get_branches(*flags: str) -> Tuple[str, ...]:
+    """
+    :returns: branch names, as listed by `git branch` (e.g. "* master").
+    :raises: subprocess.CalledProcessError
+    """
+    return tuple(run('branch', *flags, colorize=False).splitlines())
+
+
+@contextmanager
+def target(directory: str) -> Iterator[None]:
+    """
+    Runs all git commands within this context against the specified repository.
+    """
+    global _target_directory
+    original_directory = _target_directory
+    _target_directory = directory
+    try:
+        yield
+    finally:
+        _target_directory = original_directory
+
+
+def get_git_directory() -> str:
+    """
+    :raises: subprocess.CalledProcessError
+    """
+    return _get_git_directory(_target_directory, os.getcwd())
+
+
+@lru_cache(maxsize=None)
+def _get_git_directory(target_directory: Optional[str], current_directory: str) -> str:
+    # NOTE: Unlike `cached` functions, this never changes when the repository is mutated.
+    return run('rev-parse', '--absolute-git-dir', colorize=False)
+
 
 @lru_cache(maxsize=1)
 def _get_path_to_original_git() -> str:
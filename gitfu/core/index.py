@@ -0,0 +1,274 @@
+"""
+Reads git's index (`.git/index`, versions 2 through 4) directly, so that we can compare
+its cached stat data against the worktree without asking git to re-hash files.
+
+Source: https://git-scm.com/docs/index-format
+"""
+import mmap
+import os
+import stat
+import struct
+import subprocess
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+from . import git
+from ..exceptions import GitfuException
+
+
+SIGNATURE = b'DIRC'
+SUPPORTED_VERSIONS = {2, 3, 4}
+
+# ctime (s, ns), mtime (s, ns), dev, ino, mode, uid, gid, size
+ENTRY_STAT = struct.Struct('>10I')
+HEADER = struct.Struct('>4sII')
+EXTENSION_HEADER = struct.Struct('>4sI')
+UINT16 = struct.Struct('>H')
+
+FLAG_EXTENDED = 0x4000
+FLAG_STAGE_MASK = 0x3000
+NAME_LENGTH_MASK = 0x0FFF
+EXTENDED_FLAG_SKIP_WORKTREE = 0x4000
+EXTENDED_FLAG_INTENT_TO_ADD = 0x2000
+
+
+class UnsupportedIndexError(GitfuException):
+    """
+    The index uses a format (or extension) that we can't interpret, so callers should
+    fall back to asking git.
+    """
+    pass
+
+
+class IndexEntry(NamedTuple):
+    path: str
+    ctime_seconds: int
+    ctime_nanoseconds: int
+    mtime_seconds: int
+    mtime_nanoseconds: int
+    inode: int
+    mode: int
+    size: int
+    blob: str
+    stage: int
+    is_skip_worktree: bool
+    is_intent_to_add: bool
+
+
+def read_index(
+    path: Optional[str] = None,
+    paths: Optional[Iterable[str]] = None,
+    hash_size: Optional[int] = None,
+) -> Dict[str, IndexEntry]:
+    """
+    :param path: defaults to the current repository's index.
+    :param paths: if specified, only these entries are returned (relative to the
+        repository root).
+    :raises: UnsupportedIndexError
+    """
+    if not path:
+        path = get_index_path()
+    if not hash_size:
+        hash_size = get_hash_size()
+
+    wanted: Optional[Set[str]] = set(paths) if paths is not None else None
+    try:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return _parse(data, wanted, hash_size)
+    except (OSError, ValueError) as e:
+        # e.g. the index doesn't exist (no commits yet), or is empty.
+        raise UnsupportedIndexError(str(e))
+    except struct.error as e:
+        raise UnsupportedIndexError(f'Truncated index: {e}')
+
+
+def get_modified_paths(
+    entries: Dict[str, IndexEntry],
+    root: str,
+    index_mtime: float,
+) -> List[str]:
+    """
+    :returns: paths (relative to the root) whose worktree stat data no longer matches
+        the index. These may, or may not, have different content.
+    """
+    return [
+        path
+        for path, entry in entries.items()
+        if is_modified(entry, os.path.join(root, path), index_mtime)
+    ]
+
+
+def is_modified(entry: IndexEntry, path: str, index_mtime: float) -> bool:
+    """
+    Mirrors git's own stat comparison (see `ie_match_stat`), erring on the side
+    of reporting changes.
+    """
+    if entry.is_skip_worktree:
+        # Outside of the sparse-checkout, so git ignores the worktree for these.
+        return False
+
+    if entry.stage or entry.is_intent_to_add:
+        return True
+
+    try:
+        file_stat = os.lstat(path)
+    except OSError:
+        return True
+
+    if stat.S_IFMT(file_stat.st_mode) != stat.S_IFMT(entry.mode):
+        return True
+
+    if stat.S_ISREG(entry.mode) and bool(file_stat.st_mode & 0o100) != bool(entry.mode & 0o100):
+        return True
+
+    if (
+        (file_stat.st_size & 0xFFFFFFFF) != entry.size
+        or (entry.inode and (file_stat.st_ino & 0xFFFFFFFF) != entry.inode)
+        or not _matches_time(file_stat.st_mtime_ns, entry.mtime_seconds, entry.mtime_nanoseconds)
+        or not _matches_time(file_stat.st_ctime_ns, entry.ctime_seconds, entry.ctime_nanoseconds)
+    ):
+        return True
+
+    # "Racily clean" entries could have been modified within the same timestamp
+    # granularity as the index was written, so their stat data can't be trusted.
+    if entry.mtime_seconds >= int(index_mtime):
+        return True
+
+    return False
+
+
+def get_index_path() -> str:
+    return os.environ.get('GIT_INDEX_FILE') or os.path.join(git.get_git_directory(), 'index')
+
+
+def get_hash_size() -> int:
+    try:
+        object_format = git.run('rev-parse', '--show-object-format', colorize=False)
+    except subprocess.CalledProcessError:
+        # Older versions of git only support SHA-1.
+        object_format = 'sha1'
+
+    return 32 if object_format == 'sha256' else 20
+
+
+def _parse(data: mmap.mmap, wanted: Optional[Set[str]], hash_size: int) -> Dict[str, IndexEntry]:
+    signature, version, count = HEADER.unpack_from(data, 0)
+    if signature != SIGNATURE:
+        raise UnsupportedIndexError('Not a git index.')
+    if version not in SUPPORTED_VERSIONS:
+        raise UnsupportedIndexError(f'Unsupported index version: {version}')
+
+    entries = {}
+    offset = HEADER.size
+    previous_path = b''
+    for _ in range(count):
+        entry_start = offset
+        (
+            ctime_seconds, ctime_nanoseconds, mtime_seconds, mtime_nanoseconds,
+            _, inode, mode, _, _, size,
+        ) = ENTRY_STAT.unpack_from(data, offset)
+        offset += ENTRY_STAT.size
+
+        blob = data[offset:offset + hash_size].hex()
+        offset += hash_size
+
+        flags, = UINT16.unpack_from(data, offset)
+        offset += UINT16.size
+
+        extended_flags = 0
+        if flags & FLAG_EXTENDED:
+            if version < 3:
+                raise UnsupportedIndexError('Extended flags in a version 2 index.')
+
+            extended_flags, = UINT16.unpack_from(data, offset)
+            offset += UINT16.size
+
+        if version == 4:
+            # Paths are prefix-compressed against the previous entry.
+            strip_length, offset = _read_varint(data, offset)
+            end = data.find(b'\0', offset)
+            path = previous_path[:len(previous_path) - strip_length] + data[offset:end]
+            offset = end + 1
+        else:
+            name_length = flags & NAME_LENGTH_MASK
+            if name_length == NAME_LENGTH_MASK:
+                # The name is too long to fit in the flags.
+                name_length = data.find(b'\0', offset) - offset
+
+            path = data[offset:offset + name_length]
+
+            # Entries are padded with 1-8 NUL bytes, to a multiple of 8 bytes.
+            offset = entry_start + ((offset + name_length - entry_start + 8) // 8) * 8
+
+        previous_path = path
+        if stat.S_ISDIR(mode):
+            # i.e. a sparse directory entry.
+            raise UnsupportedIndexError('Sparse indexes are not supported.')
+
+        decoded_path = os.fsdecode(path)
+        if wanted is not None and decoded_path not in wanted:
+            continue
+
+        entries[decoded_path] = IndexEntry(
+            path=decoded_path,
+            ctime_seconds=ctime_seconds,
+            ctime_nanoseconds=ctime_nanoseconds,
+            mtime_seconds=mtime_seconds,
+            mtime_nanoseconds=mtime_nanoseconds,
+            inode=inode,
+            mode=mode,
+            size=size,
+            blob=blob,
+            stage=(flags & FLAG_STAGE_MASK) >> 12,
+            is_skip_worktree=bool(extended_flags & EXTENDED_FLAG_SKIP_WORKTREE),
+            is_intent_to_add=bool(extended_flags & EXTENDED_FLAG_INTENT_TO_ADD),
+        )
+
+    _check_extensions(data, offset, hash_size)
+    return entries
+
+
+def _check_extensions(data: mmap.mmap, offset: int, hash_size: int) -> None:
+    """
+    Extensions with a lowercase signature must be understood to interpret the entries
+    (e.g. "link" for split indexes, "sdir" for sparse indexes). Others are optional.
+
+    :raises: UnsupportedIndexError
+    """
+    end = len(data) - hash_size
+    while offset + EXTENSION_HEADER.size <= end:
+        signature, size = EXTENSION_HEADER.unpack_from(data, offset)
+        if b'a' <= signature[:1] <= b'z':
+            raise UnsupportedIndexError(f'Unsupported index extension: {signature.decode()}')
+
+        offset += EXTENSION_HEADER.size + size
+
+
+def _read_varint(data: mmap.mmap, offset: int) -> Tuple[int, int]:
+    """
+    Git's offset encoding (which differs slightly from a typical varint).
+
+    :returns: (value, new offset)
+    """
+    byte = data[offset]
+    offset += 1
+    value = byte & 0x7F
+    while byte & 0x80:
+        byte = data[offset]
+        offset += 1
+        value = ((value + 1) << 7) | (byte & 0x7F)
+
+    return value, offset
+
+
+def _matches_time(stat_nanoseconds: int, seconds: int, nanoseconds: int) -> bool:
+    if (stat_nanoseconds // 1000000000) & 0xFFFFFFFF != seconds:
+        return False
+
+    # Some platforms (or filesystems) don't record nanoseconds.
+    return not nanoseconds or stat_nanoseconds % 1000000000 == nanoseconds
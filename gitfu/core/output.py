@@ -0,0 +1,47 @@
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+from typing import Iterator
+
+
+class CapturedOutput:
+    def __init__(self) -> None:
+        self.stdout = ''
+        self.stderr = ''
+
+
+@contextmanager
+def capture(merge_stderr: bool = False) -> Iterator[CapturedOutput]:
+    """
+    Redirects stdout and stderr at the file descriptor level, so that output from
+    git subprocesses (e.g. `capture_output=False`) is collected as well.
+
+    The yielded object is populated with the output once the context exits.
+
+    :param merge_stderr: if True, stderr is interleaved into stdout (as it would
+        appear on a terminal).
+    """
+    output = CapturedOutput()
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    # NOTE: These are read back as bytes, since commands may output anything (e.g. binary
+    # blobs), and that shouldn't fail the command that produced it.
+    with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+        original_descriptors = [os.dup(1), os.dup(2)]
+        os.dup2(stdout.fileno(), 1)
+        os.dup2(stdout.fileno() if merge_stderr else stderr.fileno(), 2)
+        try:
+            yield output
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            for descriptor, original in enumerate(original_descriptors, start=1):
+                os.dup2(original, descriptor)
+                os.close(original)
+
+            stdout.seek(0)
+            output.stdout = stdout.read().decode(errors='replace')
+            stderr.seek(0)
+            output.stderr = stderr.read().decode(errors='replace')
@@ -0,0 +1,53 @@
+import os
+import subprocess
+import sys
+from contextlib import contextmanager
+from typing import Iterator
+from typing import TextIO
+
+from . import git
+
+
+@contextmanager
+def open_pager() -> Iterator[TextIO]:
+    """
+    Yields a stream that is displayed through the user's pager (as git would),
+    or stdout, if we're not writing to a terminal.
+
+    If the user quits the pager early, writing to this stream raises BrokenPipeError.
+    """
+    command = _get_pager_command() if sys.stdout.isatty() else ''
+    if not command or command == 'cat':
+        yield sys.stdout
+        return
+
+    # These are the same defaults that git uses.
+    env = os.environ.copy()
+    env.setdefault('LESS', 'FRX')
+    env.setdefault('LV', '-c')
+
+    sys.stdout.flush()
+    process = subprocess.Popen(
+        command,
+        shell=True,
+        stdin=subprocess.PIPE,
+        env=env,
+        universal_newlines=True,
+    )
+    try:
+        yield process.stdin  # type: ignore
+    finally:
+        try:
+            process.stdin.close()  # type: ignore
+        except BrokenPipeError:
+            pass
+
+        process.wait()
+
+
+def _get_pager_command() -> str:
+    # NOTE: This takes `$GIT_PAGER`, `core.pager` and `$PAGER` into account.
+    try:
+        return git.run('var', 'GIT_PAGER', colorize=False)
+    except subprocess.CalledProcessError:
+        return ''
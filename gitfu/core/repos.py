@@ -0,0 +1,229 @@
+"""
+Fans gitfu operations out across multiple repositories, with a bounded process pool.
+"""
+import argparse
+import glob
+import os
+import subprocess
+import sys
+import traceback
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+from . import color
+from . import git
+from . import output
+from ..exceptions import GitfuException
+
+
+class RepositoryResult(NamedTuple):
+    repository: str
+    returncode: int
+    output: str
+
+    # Whatever the function returned (for multi-phase operations, like aggregated prompts).
+    value: Any = None
+
+
+def add_arguments(
+    parser: argparse.ArgumentParser,
+    jobs_flags: Tuple[str, ...] = ('-j', '--jobs'),
+) -> None:
+    group = parser.add_argument_group('multi-repository mode')
+    group.add_argument(
+        '--repos',
+        metavar='GLOB',
+        help='Runs this command in every git repository matching this glob.',
+    )
+    group.add_argument(
+        '--repos-from-file',
+        metavar='FILENAME',
+        help='Runs this command in every git repository listed (one per line) in this file.',
+    )
+    group.add_argument(
+        *jobs_flags,
+        dest='jobs',
+        type=int,
+        help='Maximum number of repositories to process at once. Defaults to the CPU count.',
+    )
+
+
+def is_requested(args: argparse.Namespace) -> bool:
+    return bool(getattr(args, 'repos', None) or getattr(args, 'repos_from_file', None))
+
+
+def get_repositories(args: argparse.Namespace) -> List[str]:
+    """
+    :raises: GitfuException
+    """
+    candidates = []
+    if args.repos:
+        candidates.extend(glob.glob(os.path.expanduser(args.repos)))
+
+    if args.repos_from_file:
+        try:
+            with open(args.repos_from_file) as f:
+                candidates.extend(
+                    os.path.expanduser(line.strip())
+                    for line in f
+                    if line.strip() and not line.startswith('#')
+                )
+        except OSError as e:
+            raise GitfuException(f'Unable to read {args.repos_from_file}: {e.strerror}')
+
+    repositories = sorted({
+        os.path.normpath(candidate)
+        for candidate in candidates
+        # NOTE: `.git` is a file for worktrees and submodules.
+        if os.path.exists(os.path.join(candidate, '.git'))
+    })
+    if not repositories:
+        raise GitfuException('No git repositories found.')
+
+    return repositories
+
+
+def run(
+    func: Callable[..., Any],
+    arguments: Dict[str, Sequence[Any]],
+    jobs: Optional[int] = None,
+) -> List[RepositoryResult]:
+    """
+    Runs `func` in each repository (with the respective arguments), and collects
+    its output. A failure in one repository does not stop the others.
+
+    NOTE: Since the work is performed in separate processes, `func` (and its arguments)
+    need to be picklable. Also, there is no stdin in these processes: any confirmation
+    prompts need to be aggregated, and asked in the parent process.
+    """
+    if not arguments:
+        return []
+
+    # NOTE: This is imported here, since it takes a while (and most runs don't need it).
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(
+        max_workers=min(jobs or os.cpu_count() or 1, len(arguments)),
+        initializer=_initialize_worker,
+    ) as executor:
+        futures = [
+            executor.submit(_run_in_repository, repository, func, *args)
+            for repository, args in arguments.items()
+        ]
+
+        results = []
+        for repository, future in zip(arguments, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                # e.g. the worker process died, or the result couldn't be pickled.
+                results.append(
+                    RepositoryResult(
+                        repository=repository,
+                        returncode=1,
+                        output=f'{type(e).__name__}: {e}',
+                    ),
+                )
+
+        return results
+
+
+def run_from_args(args: argparse.Namespace, func: Callable[..., Any], *func_args: Any) -> int:
+    """
+    Convenience function for commands with no aggregated prompts.
+    """
+    try:
+        repositories = get_repositories(args)
+    except GitfuException as e:
+        print(f'{color.colorize("ERROR", color.AnsiColor.RED)}: {e}', file=sys.stderr)
+        return 1
+
+    results = run(
+        func,
+        {repository: func_args for repository in repositories},
+        jobs=args.jobs,
+    )
+    return print_results(results)
+
+
+def print_results(results: List[RepositoryResult]) -> int:
+    """
+    Prints the collated output for each repository, and summarizes the failures.
+
+    :returns: returncode that represents all results.
+    """
+    failures = []
+    for result in results:
+        if result.returncode:
+            failures.append(result.repository)
+
+        if not result.output and not result.returncode:
+            continue
+
+        print(color.colorize(f'==> {result.repository} <==', color.AnsiColor.YELLOW))
+        if result.output:
+            print(result.output)
+
+        print()
+
+    if failures:
+        print(
+            (
+                f'{color.colorize("ERROR", color.AnsiColor.RED)}: '
+                f'Failed in {len(failures)} of {len(results)} repositories:\n - '
+                + '\n - '.join(failures)
+            ),
+            file=sys.stderr,
+        )
+        return 1
+
+    return 0
+
+
+def _initialize_worker() -> None:
+    # There's no way to multiplex prompts from several processes onto the same terminal,
+    # so make sure that anything that prompts fails fast, rather than hanging.
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+
+
+def _run_in_repository(repository: str, func: Callable[..., Any], *args: Any) -> RepositoryResult:
+    returncode = 0
+    value = None
+
+    # Worker processes are reused, so make sure that commands which manipulate
+    # `sys.argv` do not affect each other.
+    original_argv = sys.argv[:]
+    with output.capture(merge_stderr=True) as captured:
+        try:
+            with git.target(repository):
+                value = func(*args)
+        except subprocess.CalledProcessError as e:
+            print(e.stderr or e.stdout or str(e), file=sys.stderr)
+            returncode = e.returncode or 1
+        except GitfuException as e:
+            print(str(e), file=sys.stderr)
+            returncode = 1
+        except (Exception, SystemExit):
+            traceback.print_exc()
+            returncode = 1
+        else:
+            # Commands indicate failure through their return code.
+            if isinstance(value, int) and not isinstance(value, bool):
+                returncode = value
+        finally:
+            sys.argv = original_argv
+
+    return RepositoryResult(
+        repository=repository,
+        returncode=returncode,
+        output=captured.stdout.rstrip(),
+        value=value,
+    )
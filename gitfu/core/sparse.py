@@ -0,0 +1,100 @@
+"""
+Remembers the sparse-checkout definition (e.g. the cone of directories) that was used on
+each branch, so that it can be restored when switching back to that branch.
+
+Profiles are journaled under `.git/gitfu/`; the latest entry for a branch wins.
+"""
+import os
+import subprocess
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+from . import git
+from . import storage
+
+
+PROFILES_FILENAME = 'sparse-profiles.jsonl'
+
+
+class Profile(NamedTuple):
+    is_cone: bool
+
+    # In cone mode, these are directories (relative to the repository root).
+    # Otherwise, they are gitignore-style patterns.
+    patterns: Tuple[str, ...]
+
+    def contains(self, path: str) -> bool:
+        """
+        :param path: relative to the repository root.
+        """
+        if not self.is_cone:
+            # Non-cone patterns are too expressive to evaluate ourselves, so leave it to git.
+            return True
+
+        # Files at the root (and directly inside any parent of a cone directory) are
+        # always included.
+        parent = os.path.dirname(path)
+        return not parent or any(
+            path.startswith(f'{directory}/')
+            or f'{directory}/'.startswith(f'{parent}/')
+            for directory in self.patterns
+        )
+
+
+def is_enabled() -> bool:
+    return _get_config('core.sparseCheckout') == 'true'
+
+
+def get_profile() -> Optional[Profile]:
+    """
+    :returns: the current sparse-checkout definition, if sparse-checkout is enabled.
+    """
+    if not is_enabled():
+        return None
+
+    return Profile(
+        is_cone=_get_config('core.sparseCheckoutCone') == 'true',
+        patterns=tuple(git.run('sparse-checkout', 'list', colorize=False).splitlines()),
+    )
+
+
+def apply_profile(profile: Profile) -> None:
+    """
+    Only the changes between the current and new definitions are (de)materialized. This
+    keeps the sparse index (`index.sparse`) setting as-is.
+
+    :raises: subprocess.CalledProcessError
+    """
+    git.run(
+        'sparse-checkout', 'set',
+        '--cone' if profile.is_cone else '--no-cone',
+        '--', *profile.patterns,
+    )
+
+
+def save_profile(branch: str, profile: Profile) -> None:
+    storage.append_journal(
+        storage.get_path(PROFILES_FILENAME),
+        {
+            'branch': branch,
+            'cone': profile.is_cone,
+            'patterns': list(profile.patterns),
+        },
+    )
+
+
+def load_profile(branch: str) -> Optional[Profile]:
+    profile = None
+    for entry in storage.read_journal(storage.get_path(PROFILES_FILENAME)):
+        if entry.get('branch') == branch:
+            profile = Profile(is_cone=entry['cone'], patterns=tuple(entry['patterns']))
+
+    return profile
+
+
+def _get_config(key: str) -> str:
+    try:
+        return git.run('config', '--bool', '--get', key, colorize=False) or ''
+    except subprocess.CalledProcessError:
+        return ''
@@ -0,0 +1,49 @@
+"""
+Persists gitfu state per repository, under `.git/gitfu/`.
+"""
+import json
+import os
+from typing import Any
+from typing import Dict
+from typing import Iterator
+
+from . import git
+
+
+def get_path(filename: str) -> str:
+    """
+    :raises: subprocess.CalledProcessError
+    """
+    directory = os.path.join(git.get_git_directory(), 'gitfu')
+    os.makedirs(directory, exist_ok=True)
+
+    return os.path.join(directory, filename)
+
+
+def read_journal(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Journals are append-only (one JSON object per line), so that recording a new entry
+    does not need to rewrite everything that came before it.
+    """
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # Most likely, the process was killed halfway through a write.
+                    continue
+    except FileNotFoundError:
+        return
+
+
+def append_journal(path: str, entry: Dict[str, Any]) -> None:
+    with open(path, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+
+def delete(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
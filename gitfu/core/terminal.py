@@ -0,0 +1,92 @@
+"""
+Single-keypress input, and screen control, for interactive prompts.
+"""
+import os
+import platform
+import select
+import sys
+from contextlib import contextmanager
+from typing import Iterator
+
+try:
+    import termios
+    import tty
+except ImportError:     # pragma: no cover
+    # e.g. Windows. Prompts fall back to line-buffered input.
+    termios = None      # type: ignore
+    tty = None          # type: ignore
+
+
+# Moves the cursor home, then clears the screen (and the scrollback).
+CLEAR_SCREEN = '\x1b[H\x1b[2J\x1b[3J'
+
+# How long to wait for the rest of an escape sequence (in seconds).
+ESCAPE_SEQUENCE_TIMEOUT = 0.01
+
+
+def is_interactive() -> bool:
+    """
+    :returns: True if single keypresses can be read.
+    """
+    return termios is not None and sys.stdin.isatty()
+
+
+@contextmanager
+def cbreak() -> Iterator[None]:
+    """
+    While active, keys are delivered as soon as they're pressed (and aren't echoed).
+    Keys typed ahead (e.g. while output is still rendering) stay buffered, to be read
+    by the next `read_key`.
+    """
+    if not is_interactive():
+        yield
+        return
+
+    fd = sys.stdin.fileno()
+    original_attributes = termios.tcgetattr(fd)
+    try:
+        # NOTE: The default (TCSAFLUSH) would discard anything typed ahead.
+        tty.setcbreak(fd, termios.TCSANOW)
+        yield
+    finally:
+        termios.tcsetattr(fd, termios.TCSADRAIN, original_attributes)
+
+
+def read_key() -> str:
+    """
+    Should be used within `cbreak`, otherwise keys are only delivered after Enter.
+
+    :returns: the key that was pressed, or an empty string for keys that don't map to
+        a character (e.g. arrow keys).
+    :raises: EOFError
+    """
+    fd = sys.stdin.fileno()
+    key = os.read(fd, 1)
+    if not key or key == b'\x04':
+        raise EOFError
+
+    if key == b'\x1b':
+        # Escape sequences are consumed whole, so that they aren't mistaken for
+        # separate keypresses (e.g. the "B" in the down arrow's `ESC [ B`).
+        sequence = key
+        while select.select([fd], [], [], ESCAPE_SEQUENCE_TIMEOUT)[0]:
+            sequence += os.read(fd, 1)
+            if len(sequence) > 2 and 0x40 <= sequence[-1] <= 0x7E:
+                break
+
+        return ''
+
+    return key.decode(errors='ignore')
+
+
+def clear_screen() -> None:
+    if not sys.stdout.isatty():
+        return
+
+    if platform.system() == 'Windows':
+        os.system('cls')
+        return
+
+    # This avoids spawning a shell (and `clear`) every time.
+    sys.stdout.write(CLEAR_SCREEN)
+    sys.stdout.flush()
@@ -0,0 +1,358 @@
+"""
+Watches a worktree for changes, so that git doesn't need to scan the whole tree.
+
+On Linux, this uses inotify (through ctypes, so that there are no extra dependencies).
+Everywhere else (or if we run out of inotify watches), it falls back to polling.
+"""
+import abc
+import ctypes
+import ctypes.util
+import errno
+import itertools
+import os
+import select
+import struct
+import time
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+from ..exceptions import GitfuException
+
+
+# Source: /usr/include/linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+    | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+)
+
+# struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]; }
+EVENT_HEADER = struct.Struct('iIII')
+
+MAX_USER_WATCHES_PATH = '/proc/sys/fs/inotify/max_user_watches'
+
+# How often the polling watcher checks for new cookies (in seconds).
+COOKIE_POLL_INTERVAL = 0.005
+
+
+class WatcherUnavailableError(GitfuException):
+    pass
+
+
+class WatcherOverflowError(GitfuException):
+    """
+    Changes were dropped (e.g. the kernel's event queue overflowed), so anything
+    may have changed since the last read.
+    """
+    pass
+
+
+class Watcher(abc.ABC):
+    # Whether files created in the cookie directory are reported, in order with all
+    # other changes (see `read`).
+    supports_cookies = False
+
+    def __init__(self, root: str, cookie_directory: Optional[str] = None) -> None:
+        self.root = os.path.abspath(root)
+        self.cookie_directory = (
+            os.path.abspath(cookie_directory) if cookie_directory else None
+        )
+
+    @abc.abstractmethod
+    def read(self, timeout: Optional[float] = None) -> List[str]:
+        """
+        Blocks until something changes (or the timeout expires).
+
+        :returns: paths relative to the root. Directories end with a `/`, indicating
+            that anything inside them may have changed. Cookies are reported as absolute
+            paths, so that they can't be confused with changes to the worktree.
+        :raises: WatcherOverflowError
+        """
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyWatcher(Watcher):
+    supports_cookies = True
+
+    def __init__(self, root: str, cookie_directory: Optional[str] = None) -> None:
+        """
+        :raises: WatcherUnavailableError
+        """
+        super().__init__(root, cookie_directory)
+
+        self._libc = _get_libc()
+        if not self._libc or not hasattr(self._libc, 'inotify_init1'):
+            raise WatcherUnavailableError('inotify is not supported on this platform.')
+
+        self._fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            raise WatcherUnavailableError(os.strerror(ctypes.get_errno()))
+
+        self._directories: Dict[int, str] = {}
+        try:
+            for directory in _walk_directories(self.root):
+                self._add_watch(directory)
+
+            if self.cookie_directory:
+                # This is typically inside `.git`, which isn't watched otherwise.
+                self._add_watch(self.cookie_directory)
+        except WatcherUnavailableError:
+            self.close()
+            raise
+
+    def read(self, timeout: Optional[float] = None) -> List[str]:
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+
+        buffer = os.read(self._fd, 1024 * 1024)
+        paths = []
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(buffer[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                raise WatcherOverflowError
+
+            directory = self._directories.get(wd)
+            if directory is None:
+                continue
+
+            if mask & IN_IGNORED:
+                del self._directories[wd]
+                continue
+
+            if not name:
+                # Events on the watched directory itself are also reported by its parent.
+                continue
+
+            path = os.path.join(directory, name)
+            if directory == self.cookie_directory:
+                if mask & IN_CREATE:
+                    paths.append(path)
+
+                continue
+
+            relative_path = os.path.relpath(path, self.root)
+            if _is_git_directory(relative_path):
+                continue
+
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Files may have been added to the directory before we started watching.
+                    for subdirectory in _walk_directories(path):
+                        self._add_watch(subdirectory)
+
+                paths.append(relative_path.rstrip('/') + '/')
+            else:
+                paths.append(relative_path)
+
+        return paths
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+    def _add_watch(self, directory: str) -> None:
+        """
+        :raises: WatcherUnavailableError
+        """
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+        if wd >= 0:
+            self._directories[wd] = directory
+            return
+
+        error = ctypes.get_errno()
+        if error in {errno.ENOENT, errno.ENOTDIR}:
+            # Removed before we got to it.
+            return
+
+        if error == errno.ENOSPC:
+            raise WatcherUnavailableError(
+                'Too many directories to watch. '
+                'Consider raising /proc/sys/fs/inotify/max_user_watches.',
+            )
+
+        raise WatcherUnavailableError(os.strerror(error))
+
+
+class PollingWatcher(Watcher):
+    """
+    Stats the worktree, and compares it against the previous snapshot. This is much slower
+    than inotify, since every path needs to be stat-ed again.
+
+    With a cookie directory, the worktree is only scanned once a cookie is created (i.e. when
+    git asks what changed), rather than continuously in the background. Otherwise, it is
+    scanned every interval.
+    """
+    supports_cookies = True
+
+    def __init__(
+        self,
+        root: str,
+        cookie_directory: Optional[str] = None,
+        interval: float = 2.0,
+    ) -> None:
+        super().__init__(root, cookie_directory)
+        self.interval = interval
+        self._snapshot = self._take_snapshot()
+        self._cookies: Set[str] = set()
+
+    def read(self, timeout: Optional[float] = None) -> List[str]:
+        if self.cookie_directory:
+            cookies = self._wait_for_cookies(timeout)
+            if not cookies:
+                return []
+        else:
+            time.sleep(self.interval if timeout is None else min(self.interval, timeout))
+            cookies = []
+
+        # NOTE: Since this scan starts after the cookies were created, it includes everything
+        # that changed before then. Hence, the cookies are reported last.
+        snapshot = self._take_snapshot()
+        paths = [
+            path
+            for path in snapshot.keys() | self._snapshot.keys()
+            if snapshot.get(path) != self._snapshot.get(path)
+        ]
+        self._snapshot = snapshot
+
+        return [*paths, *cookies]
+
+    def _wait_for_cookies(self, timeout: Optional[float] = None) -> List[str]:
+        """
+        :returns: absolute paths to cookies that haven't been reported yet.
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            try:
+                cookies = set(os.listdir(self.cookie_directory))
+            except FileNotFoundError:
+                cookies = set()
+
+            new_cookies = cookies - self._cookies
+            # Cookies are removed once they're seen, so this doesn't grow.
+            self._cookies = cookies
+            if new_cookies:
+                return [
+                    os.path.join(self.cookie_directory, name)   # type: ignore
+                    for name in sorted(new_cookies)
+                ]
+
+            if deadline is not None and time.monotonic() > deadline:
+                return []
+
+            time.sleep(COOKIE_POLL_INTERVAL)
+
+    def _take_snapshot(self) -> Dict[str, Tuple[int, int, int, int]]:
+        snapshot = {}
+        for directory in _walk_directories(self.root):
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+
+            for entry in entries:
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+
+                relative_path = os.path.relpath(entry.path, self.root)
+                if _is_git_directory(relative_path):
+                    continue
+
+                if entry.is_dir(follow_symlinks=False):
+                    # A directory's mtime changes whenever its children do, which we
+                    # already track individually. Only report it when it's (re)created.
+                    snapshot[relative_path + '/'] = (0, 0, 0, stat.st_ino)
+                    continue
+
+                snapshot[relative_path] = (
+                    stat.st_mtime_ns, stat.st_ctime_ns, stat.st_size, stat.st_ino,
+                )
+
+        return snapshot
+
+
+def get_watcher(root: str, cookie_directory: Optional[str] = None) -> Watcher:
+    try:
+        return InotifyWatcher(root, cookie_directory)
+    except WatcherUnavailableError:
+        return PollingWatcher(root, cookie_directory)
+
+
+def is_inotify_supported(root: str) -> bool:
+    """
+    :returns: whether the worktree can be watched with inotify (rather than polling).
+    """
+    libc = _get_libc()
+    if not libc or not hasattr(libc, 'inotify_init1'):
+        return False
+
+    try:
+        with open(MAX_USER_WATCHES_PATH) as f:
+            max_watches = int(f.read())
+    except (OSError, ValueError):
+        return True
+
+    # NOTE: Watches used by other processes also count towards this limit, so this is
+    # optimistic.
+    directories = itertools.islice(_walk_directories(root), max_watches)
+    return sum(1 for _ in directories) < max_watches
+
+
+def _walk_directories(root: str) -> Iterator[str]:
+    yield root
+
+    try:
+        entries = list(os.scandir(root))
+    except OSError:
+        return
+
+    for entry in entries:
+        if entry.name == '.git' or not entry.is_dir(follow_symlinks=False):
+            continue
+
+        yield from _walk_directories(entry.path)
+
+
+def _is_git_directory(relative_path: str) -> bool:
+    return relative_path == '.git' or relative_path.startswith('.git' + os.sep)
+
+
+def _get_libc() -> Optional[ctypes.CDLL]:
+    name = ctypes.util.find_library('c')
+    if not name:
+        return None
+
+    try:
+        return ctypes.CDLL(name, use_errno=True)
+    except OSError:
+        return None
@@ -0,0 +1,383 @@
+"""
+Implements git's fsmonitor hook (protocol v2), backed by a background watcher.
+This allows git to only stat the paths that actually changed, rather than scanning
+the whole worktree on every status, diff, add or checkout.
+
+The watcher appends changed paths to a journal (under `.git/gitfu/`), and the hook
+replies with everything appended since the token that git last received.
+
+Before replying, the hook creates a "cookie" file, and waits for the watcher to journal
+it. Since events are journaled in order, this guarantees that everything which changed
+before git asked is included in the reply.
+"""
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+import uuid
+from typing import BinaryIO
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from .core import color
+from .core import git
+from .core import storage
+from .core import watcher
+
+
+JOURNAL_FILENAME = 'fsmonitor.journal'
+SESSION_FILENAME = 'fsmonitor.session'
+PID_FILENAME = 'fsmonitor.pid'
+LOG_FILENAME = 'fsmonitor.log'
+COOKIE_DIRECTORY = 'fsmonitor-cookies'
+
+# How long the hook waits for the watcher to catch up (in seconds), before telling git
+# to scan everything. With the polling watcher, this includes a scan of the whole worktree.
+COOKIE_TIMEOUT = 1.0
+
+# Once the journal gets this large, we start a new one (which makes git do a full scan once).
+MAX_JOURNAL_SIZE = 64 * 1024 * 1024
+
+TOKEN_PREFIX = 'gitfu'
+
+
+def run(action: str, *args: str) -> int:
+    if action == 'enable':
+        enable()
+    elif action == 'disable':
+        disable()
+    elif action == 'status':
+        print(get_status())
+    elif action == 'hook':
+        return hook(*args)
+    elif action == 'watch':
+        return watch()
+
+    return 0
+
+
+def enable() -> None:
+    """
+    :raises: subprocess.CalledProcessError
+    """
+    root = git.run('rev-parse', '--show-toplevel', colorize=False)
+    if not watcher.is_inotify_supported(root):
+        print(
+            f'{color.colorize("WARNING", color.AnsiColor.YELLOW)}: '
+            'inotify is unavailable (or there are too many directories to watch), so the '
+            'watcher will fall back to polling. git then waits for a full scan of the worktree '
+            'whenever it asks what changed, which may well be slower than without fsmonitor.',
+            file=sys.stderr,
+        )
+
+    git.run('config', 'core.fsmonitor', get_hook_command())
+    git.run('config', 'core.fsmonitorHookVersion', '2')
+    if not is_watcher_running():
+        start_watcher()
+
+
+def disable() -> None:
+    """
+    :raises: subprocess.CalledProcessError
+    """
+    for key in ['core.fsmonitor', 'core.fsmonitorHookVersion']:
+        try:
+            git.run('config', '--unset', key)
+        except subprocess.CalledProcessError as e:
+            # Already unset.
+            if e.returncode != 5:
+                raise
+
+    stop_watcher()
+
+
+def get_status() -> str:
+    try:
+        hook_command = git.run('config', '--get', 'core.fsmonitor', colorize=False)
+    except subprocess.CalledProcessError:
+        hook_command = ''
+
+    pid = _get_watcher_pid()
+    return '\n'.join([
+        'hook: ' + (hook_command or color.colorize('disabled', color.AnsiColor.YELLOW)),
+        'watcher: ' + (
+            f'running (pid {pid})' if pid
+            else color.colorize('stopped', color.AnsiColor.YELLOW)
+        ),
+    ])
+
+
+def get_hook_command() -> str:
+    # NOTE: git runs this through the shell, and appends the version and token.
+    return f'{shlex.quote(sys.executable)} -m gitfu fsmonitor hook'
+
+
+def hook(version: str = '', token: str = '', *args: str) -> int:
+    """
+    Source: https://git-scm.com/docs/githooks#_fsmonitor_watchman
+
+    :returns: non-zero if git should fall back to scanning the worktree itself.
+    """
+    if version != '2':
+        return 1
+
+    if not is_watcher_running():
+        start_watcher()
+        _write_response(_get_token(), None)
+        return 0
+
+    journal_path = storage.get_path(JOURNAL_FILENAME)
+    session, supports_cookies = _read_session()
+    if not supports_cookies:
+        # We can't tell whether the watcher has caught up, so the journal can't be trusted.
+        _write_response(_get_token(), None)
+        return 0
+
+    try:
+        with open(journal_path, 'rb') as f:
+            header = f.readline()
+            offset = _parse_token(token, session)
+            if header.rstrip(b'\n').decode(errors='replace') != session:
+                # The watcher is starting a new session.
+                _write_response(_get_token(), None)
+                return 0
+
+            if offset is None:
+                _write_response(_get_token(session, _get_end(f)), None)
+                return 0
+
+            data = _wait_for_cookie(f, offset)
+            end = offset + len(data) if data is not None else _get_end(f)
+    except FileNotFoundError:
+        _write_response(_get_token(), None)
+        return 0
+
+    if data is None:
+        _write_response(_get_token(session, end), None)
+        return 0
+
+    # Files are typically written to several times, but git only needs to know once.
+    paths = list(
+        dict.fromkeys(
+            path
+            for path in data.split(b'\0')
+            # Absolute paths are cookies.
+            if path and not path.startswith(b'/')
+        ),
+    )
+    _write_response(_get_token(session, end), paths)
+    return 0
+
+
+def watch() -> int:
+    """
+    Runs the watcher in the foreground, until it is stopped.
+    """
+    root = git.run('rev-parse', '--show-toplevel', colorize=False)
+    pid_path = storage.get_path(PID_FILENAME)
+    journal_path = storage.get_path(JOURNAL_FILENAME)
+    with open(pid_path, 'w') as f:
+        f.write(str(os.getpid()))
+
+    cookie_directory = _get_cookie_directory()
+    worktree_watcher = watcher.get_watcher(root, cookie_directory)
+    print(f'Watching {root} with {type(worktree_watcher).__name__}.', flush=True)
+
+    supports_cookies = worktree_watcher.supports_cookies
+    try:
+        journal = _start_session(journal_path, supports_cookies)
+        while _get_watcher_pid() == os.getpid():
+            try:
+                paths = worktree_watcher.read(timeout=60)
+            except watcher.WatcherOverflowError:
+                journal.close()
+                journal = _start_session(journal_path, supports_cookies)
+                continue
+
+            if paths:
+                journal.write(b''.join(os.fsencode(path) + b'\0' for path in paths))
+                journal.flush()
+
+            if journal.tell() > MAX_JOURNAL_SIZE:
+                journal.close()
+                journal = _start_session(journal_path, supports_cookies)
+    finally:
+        worktree_watcher.close()
+
+    return 0
+
+
+def is_watcher_running() -> bool:
+    return bool(_get_watcher_pid())
+
+
+def start_watcher() -> None:
+    root = git.run('rev-parse', '--show-toplevel', colorize=False)
+    with open(storage.get_path(LOG_FILENAME), 'a') as log:
+        subprocess.Popen(
+            [sys.executable, '-m', 'gitfu', 'fsmonitor', 'watch'],
+            cwd=root,
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=log,
+            # Detach from the terminal, so that it outlives this process.
+            start_new_session=True,
+        )
+
+
+def stop_watcher() -> None:
+    pid = _get_watcher_pid()
+    storage.delete(storage.get_path(PID_FILENAME))
+    if pid:
+        try:
+            os.kill(pid, 15)
+        except ProcessLookupError:
+            pass
+
+
+def _start_session(journal_path: str, supports_cookies: bool) -> BinaryIO:
+    """
+    Starts a new journal. Tokens from previous sessions become invalid, so git
+    will do a full scan the next time it asks.
+
+    The journal starts with the session id, so that the hook can tell which session
+    the journal it read belongs to (regardless of when the session file was replaced).
+    """
+    session = uuid.uuid4().hex
+
+    # NOTE: The session is replaced first, so that tokens from the previous session are
+    # rejected before the journal is replaced.
+    session_path = storage.get_path(SESSION_FILENAME)
+    with open(f'{session_path}.tmp', 'w') as f:
+        json.dump({'id': session, 'cookies': supports_cookies}, f)
+
+    os.replace(f'{session_path}.tmp', session_path)
+
+    with open(f'{journal_path}.tmp', 'wb') as f:
+        f.write(session.encode() + b'\n')
+
+    os.replace(f'{journal_path}.tmp', journal_path)
+    return open(journal_path, 'ab')
+
+
+def _read_session() -> Tuple[str, bool]:
+    """
+    :returns: (session id, whether the watcher supports cookies)
+    """
+    try:
+        with open(storage.get_path(SESSION_FILENAME)) as f:
+            session = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return '', False
+
+    if not isinstance(session, dict):
+        # e.g. written by an older version.
+        return '', False
+
+    return session.get('id', ''), bool(session.get('cookies'))
+
+
+def _get_cookie_directory() -> str:
+    directory = os.path.join(os.path.dirname(storage.get_path(JOURNAL_FILENAME)), COOKIE_DIRECTORY)
+    os.makedirs(directory, exist_ok=True)
+
+    return directory
+
+
+def _wait_for_cookie(journal: BinaryIO, offset: int) -> Optional[bytes]:
+    """
+    :returns: everything journaled from the offset, up to (and including) our cookie.
+        None if the journal can't be trusted (e.g. the watcher didn't catch up in time).
+    """
+    cookie_path = os.path.join(_get_cookie_directory(), f'{os.getpid()}-{uuid.uuid4().hex}')
+    cookie = os.fsencode(cookie_path)
+
+    with open(cookie_path, 'w'):
+        pass
+
+    try:
+        deadline = time.monotonic() + COOKIE_TIMEOUT
+        data = b''
+        while True:
+            if (
+                _get_end(journal) < offset
+                or not os.path.samestat(os.fstat(journal.fileno()), os.stat(journal.name))
+            ):
+                # The watcher started a new session (with a new journal).
+                return None
+
+            journal.seek(offset + len(data))
+            data += journal.read()
+
+            # NOTE: The offset is always at the start of a record.
+            index = (b'\0' + data).find(b'\0' + cookie + b'\0')
+            if index != -1:
+                return data[:index + len(cookie) + 1]
+
+            if time.monotonic() > deadline:
+                return None
+
+            time.sleep(0.001)
+    finally:
+        os.remove(cookie_path)
+
+
+def _get_end(f: BinaryIO) -> int:
+    return os.fstat(f.fileno()).st_size
+
+
+def _get_token(session: Optional[str] = None, offset: int = 0) -> str:
+    # NOTE: A token without a session will never match, so git will ask for a full
+    # scan again next time (i.e. until the watcher is ready).
+    return f'{TOKEN_PREFIX}:{session or "none"}:{offset}'
+
+
+def _parse_token(token: str, session: str) -> Optional[int]:
+    """
+    :returns: the journal offset that this token refers to, if it's still valid.
+    """
+    try:
+        prefix, token_session, offset = token.split(':')
+        offset = int(offset)
+    except ValueError:
+        # e.g. the first time that the hook is called.
+        return None
+
+    if prefix != TOKEN_PREFIX or not session or token_session != session:
+        return None
+
+    return offset
+
+
+def _write_response(token: str, paths: Optional[List[bytes]]) -> None:
+    """
+    :param paths: if None, tells git that anything may have changed.
+    """
+    output = sys.stdout.buffer
+    output.write(token.encode() + b'\0')
+    if paths is None:
+        output.write(b'/\0')
+    else:
+        output.write(b''.join(path + b'\0' for path in paths))
+
+    output.flush()
+
+
+def _get_watcher_pid() -> int:
+    try:
+        with open(storage.get_path(PID_FILENAME)) as f:
+            pid = int(f.read().strip())
+    except (FileNotFoundError, ValueError):
+        return 0
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return 0
+    except PermissionError:
+        pass
+
+    return pid
@@ -11,7 +11,7 @@ def main(*argv: str) -> int:
         argv = sys.argv[1:]
 
     try:
-        _process_inputs(*argv)
+        return _process_inputs(*argv)
     except subprocess.CalledProcessError as e:
         if e.stderr:
             print(e.stderr, file=sys.stderr)
@@ -24,15 +24,15 @@ def main(*argv: str) -> int:
         print(str(e), file=sys.stderr)
         return 1
 
-    return 0
-
 
-def _process_inputs(*argv: str) -> None:
+def _process_inputs(*argv: str) -> int:
     """
+    :returns: returncode
     :raises: subprocess.CalledProcessError
     """
     if not argv:
-        return git.run()
+        git.run()
+        return 0
 
     command = argv[0]
     valid_commands = [
@@ -45,14 +45,16 @@ def _process_inputs(*argv: str) -> None:
     if command not in valid_commands:
         try:
             git.run(*argv, capture_output=False)
-        except subprocess.CalledProcessError:
+        except subprocess.CalledProcessError as e:
             # Since we don't capture the output, the error message will already print
             # to console.
-            pass
+            return e.returncode
 
-        return
+        return 0
 
     sys.argv.pop()
     output = getattr(commands, command)(*argv[1:])
     if output:
         print(output)
+
+    return 0
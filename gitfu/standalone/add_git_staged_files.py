@@ -1,26 +1,120 @@
 """Re-adds all staged files."""
+import argparse
+import os
 import subprocess
 import sys
+from typing import List
+from typing import Optional
 
 from ..core import git
+from ..core import index
+from ..core import repos
 
 
-def main(*argv: str) -> None:
-    staged_files = git.run(
-        'diff', '--staged', '--name-only', '--relative',
-        '--diff-filter=ARM',
-    ).splitlines()
-    if not staged_files:
-        # If no staged files, add all tracked files.
-        git.run('add', '-u')
-    else:
-        git.run('add', *staged_files)
-
+def main(*argv: str) -> int:
+    args = parse_args(*argv)
+    if repos.is_requested(args):
+        return repos.run_from_args(args, add_staged_files)
 
-if __name__ == '__main__':
     try:
-        main()
-        sys.exit(0)
+        add_staged_files()
     except subprocess.CalledProcessError as e:
+        # e.g. the index is still locked by another process.
         print(e.stderr, file=sys.stderr)
-        sys.exit(1)
+        return 1
+
+    return 0
+
+
+def parse_args(*argv: str) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    repos.add_arguments(parser)
+
+    # NOTE: `None` is needed to print the help string.
+    return parser.parse_args(argv or None)
+
+
+def add_staged_files() -> None:
+    """
+    Only re-adds files whose stat data (e.g. mtime, size) changed since they were
+    staged, so that git doesn't need to re-hash everything else.
+
+    :raises: subprocess.CalledProcessError
+    """
+    # Index paths are relative to the repository root.
+    prefix = git.run('rev-parse', '--show-prefix', colorize=False) or ''
+    staged_paths = [
+        f'{prefix}{filename}'
+        for filename in git.stream(
+            'diff', '--staged', '--name-only', '--relative', '-z',
+            '--diff-filter=ARM',
+            delimiter=b'\0',
+        )
+    ]
+    if not staged_paths:
+        # If no staged files, add all tracked files.
+        try:
+            modified_paths = get_modified_paths()
+        except index.UnsupportedIndexError:
+            git.run('add', '-u')
+            return
+
+        _update_index(modified_paths)
+        return
+
+    try:
+        staged_paths = get_modified_paths(staged_paths)
+    except index.UnsupportedIndexError:
+        pass
+
+    _update_index(staged_paths)
+
+
+def get_modified_paths(paths: Optional[List[str]] = None) -> List[str]:
+    """
+    :param paths: relative to the repository root. If not specified, checks all
+        tracked files.
+    :returns: the paths that need to be re-added.
+    :raises: index.UnsupportedIndexError
+    """
+    root = git.run('rev-parse', '--show-toplevel', colorize=False) or ''
+    index_path = index.get_index_path()
+    try:
+        index_mtime = os.stat(index_path).st_mtime
+    except OSError as e:
+        raise index.UnsupportedIndexError(str(e))
+
+    entries = index.read_index(index_path, paths=paths)
+    if paths is None:
+        return index.get_modified_paths(entries, root, index_mtime)
+
+    return [
+        path
+        for path in paths
+        # Paths that aren't in the index are left for git to deal with.
+        if path not in entries
+        or index.is_modified(entries[path], os.path.join(root, path), index_mtime)
+    ]
+
+
+def _update_index(paths: List[str]) -> None:
+    """
+    :param paths: relative to the repository root.
+    :raises: subprocess.CalledProcessError
+    """
+    if not paths:
+        return
+
+    # NOTE: Unlike `git add`, this doesn't match every path as a pathspec (which is
+    # quadratic), and paths are sent through stdin, since there can be too many for
+    # the command line.
+    root = git.run('rev-parse', '--show-toplevel', colorize=False) or ''
+    with git.target(root):
+        git.run(
+            'update-index', '--add', '--remove', '-z', '--stdin',
+            input=b''.join(os.fsencode(path) + b'\0' for path in paths),
+        )
+
+
+if __name__ == '__main__':
+    sys.exit(main())
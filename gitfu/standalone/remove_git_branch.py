@@ -1,13 +1,29 @@
 import argparse
 import subprocess
 import sys
+from typing import List
+from typing import Optional
+from typing import Tuple
 
 from ..core import color
 from ..core import git
+from ..core import repos
+from ..exceptions import GitfuException
 
 
-def main() -> int:
-    args = parse_args()
+def main(*argv: str) -> int:
+    args = parse_args(*argv)
+    if repos.is_requested(args):
+        if not args.prune:
+            _print_error('Only --prune is supported across multiple repositories.')
+            return 1
+
+        try:
+            return prune_repositories(args.remote, repos.get_repositories(args), jobs=args.jobs)
+        except GitfuException as e:
+            _print_error(str(e))
+            return 1
+
     if args.prune:
         try:
             prune_branches(args.remote)
@@ -30,7 +46,7 @@ def main() -> int:
     return 0
 
 
-def parse_args() -> argparse.Namespace:
+def parse_args(*argv: str) -> argparse.Namespace:
     parser = argparse.ArgumentParser()
     parser.add_argument(
         '-r',
@@ -56,8 +72,10 @@ def parse_args() -> argparse.Namespace:
         nargs='?',
         help='Branch name to delete.',
     )
+    repos.add_arguments(parser)
 
-    return parser.parse_args()
+    # NOTE: `None` is needed to print the help string.
+    return parser.parse_args(argv or None)
 
 
 def delete_local_branch(*names: str, force: bool = False) -> None:
@@ -96,7 +114,7 @@ def delete_branch(name: str, remote: str, should_force: bool = False) -> None:
     local_branches = {
         item.strip(
             '* ',
-        ) for item in git.run('branch', colorize=False).splitlines()
+        ) for item in git.get_branches()
     }
     candidates = [
         candidate
@@ -129,7 +147,7 @@ def delete_branch(name: str, remote: str, should_force: bool = False) -> None:
     # Alternatively, if successful with local branch, also try deleting remote.
     remote_branches = {
         item.split()[0][len(f'{remote}/'):]
-        for item in git.run('branch', '-r', colorize=False).splitlines()
+        for item in git.get_branches('-r')
     } - {'HEAD'}
     if not candidates:
         candidates = [
@@ -167,13 +185,82 @@ def delete_branch(name: str, remote: str, should_force: bool = False) -> None:
 
 
 def prune_branches(remote: str) -> None:
+    local_branches, remote_branches = get_merged_branches(remote)
+    if not local_branches and not remote_branches:
+        print('No branches to delete!')
+        return
+
+    should_delete = _get_confirmation(*[*local_branches, *remote_branches])
+    if not should_delete:
+        print('Aborting')
+        return
+
+    try:
+        delete_merged_branches(local_branches, remote_branches, remote=remote)
+    except subprocess.CalledProcessError as e:
+        pass
+
+
+def prune_repositories(remote: str, repositories: List[str], jobs: Optional[int] = None) -> int:
+    """
+    Prunes merged branches across all repositories, with a single confirmation prompt.
+    """
+    results = repos.run(
+        get_merged_branches,
+        {repository: (remote,) for repository in repositories},
+        jobs=jobs,
+    )
+
+    failures = [result for result in results if result.returncode]
+    branches_to_delete = {
+        result.repository: result.value
+        for result in results
+        if not result.returncode and (result.value[0] or result.value[1])
+    }
+    if not branches_to_delete:
+        if failures:
+            return repos.print_results(failures)
+
+        print('No branches to delete!')
+        return 0
+
+    should_delete = _get_confirmation(
+        *[
+            f'{repository}: {name}'
+            for repository, (local_branches, remote_branches) in branches_to_delete.items()
+            for name in [
+                *local_branches,
+                *[f'{remote}/{branch}' for branch in remote_branches],
+            ]
+        ]
+    )
+    if not should_delete:
+        print('Aborting')
+        return repos.print_results(failures)
+
+    results = repos.run(
+        delete_merged_branches,
+        {
+            repository: (local_branches, remote_branches, remote)
+            for repository, (local_branches, remote_branches) in branches_to_delete.items()
+        },
+        jobs=jobs,
+    )
+    return repos.print_results([*failures, *results])
+
+
+def get_merged_branches(remote: str) -> Tuple[List[str], List[str]]:
+    """
+    :returns: (local branches, remote branches) that are already merged into the current one.
+    :raises: subprocess.CalledProcessError
+    """
     # Make sure that we have the latest sync of remote branches.
     git.run('remote', 'prune', remote)
 
     # First, determine if any local branches are already merged into the current one.
     current_branch = None
     already_merged_local_branches = []
-    for name in git.run('branch', '--merged', colorize=False).splitlines():
+    for name in git.get_branches('--merged'):
         if name.startswith('*'):
             current_branch = name.strip('* ')
             continue
@@ -188,26 +275,23 @@ def prune_branches(remote: str) -> None:
     # Then, compile a list of remote branches that need cleaning up too.
     already_merged_remote_branches = [
         line.split()[0][len(f'{remote}/'):]
-        for line in git.run('branch', '-r', '--merged', colorize=False).splitlines()
+        for line in git.get_branches('-r', '--merged')
         if line.split()[0] not in {f'{remote}/{current_branch}', f'{remote}/HEAD'}
     ]
 
-    if not already_merged_local_branches and not already_merged_remote_branches:
-        print('No branches to delete!')
-        return
+    return already_merged_local_branches, already_merged_remote_branches
 
-    should_delete = _get_confirmation(
-        *[*already_merged_local_branches, *already_merged_remote_branches]
-    )
-    if not should_delete:
-        print('Aborting')
-        return
 
-    try:
-        delete_local_branch(*already_merged_local_branches)
-        delete_remote_branch(*already_merged_remote_branches, remote=remote)
-    except subprocess.CalledProcessError as e:
-        pass
+def delete_merged_branches(
+    local_branches: List[str],
+    remote_branches: List[str],
+    remote: str,
+) -> None:
+    """
+    :raises: subprocess.CalledProcessError
+    """
+    delete_local_branch(*local_branches)
+    delete_remote_branch(*remote_branches, remote=remote)
 
 
 def _get_confirmation(*names: str) -> bool:
@@ -10,6 +10,8 @@ from typing import Tuple
 
 from ..core import color
 from ..core import git
+from ..core import repos
+from ..core import sparse
 from ..exceptions import GitfuException
 
 
@@ -29,6 +31,13 @@ class BranchChangeStrategy(Enum):
 
 def main(*argv: str) -> int:
     args = parse_args(*argv)
+    if repos.is_requested(args):
+        return repos.run_from_args(args, switch_from_args, args)
+
+    return switch_from_args(args)
+
+
+def switch_from_args(args: argparse.Namespace) -> int:
     if not args.name:
         print(show_git_branches())
         return 0
@@ -109,6 +118,7 @@ def parse_args(*argv: str) -> argparse.Namespace:
             'as a WIP commit, so it can be restored when you come back to this branch.'
         ),
     )
+    repos.add_arguments(parser)
 
     # NOTE: `None` is needed to print the help string.
     return parser.parse_args(argv or None)
@@ -124,7 +134,7 @@ def show_git_branches() -> str:
 def get_branch(name: str) -> str:
     branches = [
         candidate.strip('* ')
-        for candidate in git.run('branch', colorize=False).splitlines()
+        for candidate in git.get_branches()
         if name in candidate
     ]
 
@@ -138,6 +148,13 @@ def get_branch(name: str) -> str:
 
 
 def switch_branch(name: str, *, strategy: Optional[BranchChangeStrategy] = None) -> None:
+    # With sparse-checkout, each branch remembers its own cone (see `core.sparse`).
+    profile = sparse.get_profile()
+    if profile:
+        current_branch = _get_current_branch()
+        if current_branch and sparse.load_profile(current_branch) != profile:
+            sparse.save_profile(current_branch, profile)
+
     try:
         git.run('checkout', name)
     except subprocess.CalledProcessError as e:
@@ -151,7 +168,7 @@ def switch_branch(name: str, *, strategy: Optional[BranchChangeStrategy] = None)
             BranchChangeStrategy.SAVE: resolve_errors_through_commit,
         }.get(strategy)
 
-        with handler(error):
+        with handler(error, profile):
             git.run('checkout', name)
 
     last_commit_message = git.run(
@@ -160,10 +177,15 @@ def switch_branch(name: str, *, strategy: Optional[BranchChangeStrategy] = None)
     if last_commit_message == 'WIP: switch-branch-cache':
         git.run('reset', 'HEAD~1')
 
+    if profile:
+        dest_profile = sparse.load_profile(name)
+        if dest_profile and dest_profile != profile:
+            sparse.apply_profile(dest_profile)
+
 
 @contextmanager
-def resolve_errors_through_discard(error: str):
-    tracked_files, untracked_files = _get_blocking_files(error)
+def resolve_errors_through_discard(error: str, profile: Optional[sparse.Profile] = None):
+    tracked_files, untracked_files = _get_blocking_files(error, profile)
 
     # TODO: git reset all tracked files (unstage them, if staged)
     # TODO: git checkout all tracked files (discard changes)
@@ -172,8 +194,8 @@ def resolve_errors_through_discard(error: str):
 
 
 @contextmanager
-def resolve_errors_through_preservation(error: str):
-    tracked_files, untracked_files = _get_blocking_files(error)
+def resolve_errors_through_preservation(error: str, profile: Optional[sparse.Profile] = None):
+    tracked_files, untracked_files = _get_blocking_files(error, profile)
 
     # TODO: git stash (and see what that resolves)
     # TODO: rename untracked files to `.bak`
@@ -183,15 +205,29 @@ def resolve_errors_through_preservation(error: str):
 
 
 @contextmanager
-def resolve_errors_through_commit(error: str):
-    tracked_files, untracked_files = _get_blocking_files(error)
+def resolve_errors_through_commit(error: str, profile: Optional[sparse.Profile] = None):
+    tracked_files, untracked_files = _get_blocking_files(error, profile)
 
     git.run('add', *tracked_files, *untracked_files)
     git.run('commit', '-m', 'WIP: switch-branch-cache')
     yield
 
 
-def _get_blocking_files(error: str) -> Tuple[List[str], List[str]]:
+def _get_current_branch() -> Optional[str]:
+    branch = git.run('rev-parse', '--abbrev-ref', 'HEAD', colorize=False)
+
+    # i.e. a detached HEAD.
+    return branch if branch != 'HEAD' else None
+
+
+def _get_blocking_files(
+    error: str,
+    profile: Optional[sparse.Profile] = None,
+) -> Tuple[List[str], List[str]]:
+    """
+    :param profile: if specified, only files inside the sparse-checkout are returned.
+        Others are not materialized, so we can't (and don't need to) do anything with them.
+    """
     # NOTE: From trial and error, there are several error messages that may appear at once.
     # These are the scenarios I've encountered:
     #   1. staged file that would be overwritten by checkout
@@ -217,6 +253,14 @@ def _get_blocking_files(error: str) -> Tuple[List[str], List[str]]:
         }:
             collection.append(line.strip())
 
+    if profile:
+        tracked_files = [filename for filename in tracked_files if profile.contains(filename)]
+        untracked_files = [
+            filename
+            for filename in untracked_files
+            if profile.contains(filename)
+        ]
+
     return tracked_files, untracked_files
 
 
@@ -0,0 +1,328 @@
+"""
+Measures the git operations that gitfu depends on, and enables git's scaling
+features that are recommended for this repository (with before/after timings).
+"""
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+
+from . import fsmonitor
+from .core import color
+from .core import git
+from .core import watcher
+from .exceptions import GitfuException
+
+
+# Past these sizes, git's defaults start to noticeably slow down.
+MANY_FILES_THRESHOLD = 50000
+HUGE_FILES_THRESHOLD = 200000
+MANY_PACKS_THRESHOLD = 2
+
+BENCHMARKS = {
+    # Used by `git check`.
+    'diff --name-only': ('diff', '--name-only', '--relative'),
+    # Used by `remove-git-branch --prune`.
+    'branch --merged': ('branch', '--merged'),
+    # Used by `switch-git-branch` (i.e. the same checks that `git checkout` would do).
+    'checkout (dry run)': ('read-tree', '-m', '-n', 'HEAD'),
+    # Used by `add-git-staged-files`.
+    'add -u (dry run)': ('add', '-u', '--dry-run'),
+}
+
+
+class InvalidSettingError(GitfuException):
+    pass
+
+
+class RepositoryStats(NamedTuple):
+    tracked_files: int
+    packs: int
+    has_commit_graph: bool
+    has_multi_pack_index: bool
+
+    # Otherwise, the fsmonitor watcher falls back to polling, which is rarely faster than
+    # git's own scan.
+    supports_inotify: bool
+
+
+class Setting(NamedTuple):
+    name: str
+    description: str
+    is_enabled: Callable[[RepositoryStats], bool]
+    is_recommended: Callable[[RepositoryStats], bool]
+    apply: Callable[[], None]
+
+
+def run(
+    dry_run: bool = False,
+    names: Optional[Iterable[str]] = None,
+    repeat: int = 3,
+    as_json: bool = False,
+) -> int:
+    """
+    :raises: InvalidSettingError
+    """
+    settings = _select_settings(names)
+
+    report: Dict[str, Any] = {
+        'repository': git.run('rev-parse', '--show-toplevel', colorize=False),
+        'git_version': git.run('version', colorize=False),
+        'platform': platform.platform(),
+        'repeat': repeat,
+    }
+
+    stats = get_repository_stats()
+    report['stats'] = stats._asdict()
+    report['before'] = benchmark(repeat)
+
+    candidates = [
+        setting
+        for setting in settings
+        if not setting.is_enabled(stats)
+        and (names or setting.is_recommended(stats))
+    ]
+    report['settings'] = {
+        setting.name: {
+            'description': setting.description,
+            'enabled': setting.is_enabled(stats),
+            'recommended': setting.is_recommended(stats),
+            'applied': False,
+        }
+        for setting in settings
+    }
+
+    returncode = 0
+    if not dry_run and candidates:
+        for setting in candidates:
+            try:
+                setting.apply()
+            except subprocess.CalledProcessError as e:
+                report['settings'][setting.name]['error'] = e.stderr or str(e)
+                returncode = 1
+            else:
+                report['settings'][setting.name]['applied'] = True
+
+        report['after'] = benchmark(repeat)
+
+    if as_json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(format_report(report))
+
+    return returncode
+
+
+def get_repository_stats() -> RepositoryStats:
+    objects_directory = git.run('rev-parse', '--git-path', 'objects', colorize=False)
+    object_counts = dict(
+        line.split(': ', 1)
+        for line in git.run('count-objects', '-v', colorize=False).splitlines()
+    )
+
+    return RepositoryStats(
+        tracked_files=sum(1 for _ in git.stream('ls-files', '-z', delimiter=b'\0')),
+        packs=int(object_counts.get('packs', 0)),
+        has_commit_graph=(
+            os.path.exists(os.path.join(objects_directory, 'info', 'commit-graph'))
+            or os.path.isdir(os.path.join(objects_directory, 'info', 'commit-graphs'))
+        ),
+        has_multi_pack_index=os.path.exists(
+            os.path.join(objects_directory, 'pack', 'multi-pack-index'),
+        ),
+        supports_inotify=watcher.is_inotify_supported(
+            git.run('rev-parse', '--show-toplevel', colorize=False),
+        ),
+    )
+
+
+def benchmark(repeat: int = 3) -> Dict[str, Dict[str, Any]]:
+    """
+    :returns: median duration (in seconds) for each benchmark, and all samples.
+    """
+    output = {}
+    for name, args in BENCHMARKS.items():
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            try:
+                git.run(*args, colorize=False)
+            except subprocess.CalledProcessError:
+                # e.g. no commits yet.
+                samples = []
+                break
+
+            samples.append(time.perf_counter() - start)
+
+        output[name] = {
+            'median': round(statistics.median(samples), 4) if samples else None,
+            'samples': [round(sample, 4) for sample in samples],
+        }
+
+    return output
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    stats = report['stats']
+    output = [
+        f'Repository: {report["repository"]} ({report["git_version"]})',
+        f'  {stats["tracked_files"]} tracked files, {stats["packs"]} packs',
+        '',
+        f'Benchmarks (median of {report["repeat"]}):',
+    ]
+    for name, before in report['before'].items():
+        line = f'  {name:<20} {_format_duration(before["median"])}'
+        if 'after' in report:
+            after = report['after'][name]
+            line += f' -> {_format_duration(after["median"])}'
+            if before['median'] and after['median'] is not None:
+                change = (after['median'] - before['median']) / before['median'] * 100
+                line += f' ({change:+.0f}%)'
+
+        output.append(line)
+
+    output.extend(['', 'Settings:'])
+    for name, setting in report['settings'].items():
+        # NOTE: Padding needs to happen before colorizing, since escape codes have length.
+        if setting.get('error'):
+            status = color.colorize(f'{"failed":<12}', color.AnsiColor.RED)
+        elif setting['applied']:
+            status = color.colorize(f'{"applied":<12}', color.AnsiColor.YELLOW)
+        elif setting['enabled']:
+            status = f'{"enabled":<12}'
+        elif setting['recommended']:
+            status = color.colorize(f'{"recommended":<12}', color.AnsiColor.YELLOW)
+        else:
+            status = f'{"not needed":<12}'
+
+        output.append(f'  {name:<20} {status} {setting["description"]}')
+        if setting.get('error'):
+            output.append(f'  {"":<20} {setting["error"]}')
+
+    return '\n'.join(output)
+
+
+def _format_duration(value: Optional[float]) -> str:
+    return f'{value:.3f}s' if value is not None else 'n/a'
+
+
+def _select_settings(names: Optional[Iterable[str]]) -> List[Setting]:
+    """
+    :raises: InvalidSettingError
+    """
+    if not names:
+        return SETTINGS
+
+    settings = {setting.name: setting for setting in SETTINGS}
+    try:
+        return [settings[name] for name in names]
+    except KeyError as e:
+        raise InvalidSettingError(
+            f'Unknown setting: {e.args[0]}. Expected one of: {", ".join(settings)}',
+        )
+
+
+def _get_config(key: str) -> str:
+    try:
+        return git.run('config', '--get', key, colorize=False).lower()
+    except subprocess.CalledProcessError:
+        return ''
+
+
+def _apply_commit_graph() -> None:
+    git.run('config', 'core.commitGraph', 'true')
+    git.run('config', 'fetch.writeCommitGraph', 'true')
+    git.run('commit-graph', 'write', '--reachable', '--changed-paths')
+
+
+def _apply_multi_pack_index() -> None:
+    git.run('config', 'core.multiPackIndex', 'true')
+    git.run('multi-pack-index', 'write')
+
+
+def _apply_index_version() -> None:
+    git.run('config', 'index.version', '4')
+    git.run('update-index', '--index-version', '4')
+
+
+def _apply_untracked_cache() -> None:
+    git.run('config', 'core.untrackedCache', 'true')
+    git.run('update-index', '--untracked-cache')
+
+
+def _apply_split_index() -> None:
+    git.run('config', 'core.splitIndex', 'true')
+    git.run('update-index', '--split-index')
+
+
+def _apply_many_files() -> None:
+    git.run('config', 'feature.manyFiles', 'true')
+
+
+SETTINGS = [
+    Setting(
+        name='commit-graph',
+        description='Speeds up history walks (e.g. `branch --merged`) with generation numbers.',
+        is_enabled=lambda stats: stats.has_commit_graph,
+        is_recommended=lambda stats: True,
+        apply=_apply_commit_graph,
+    ),
+    Setting(
+        name='multi-pack-index',
+        description='Speeds up object lookups across many packfiles.',
+        is_enabled=lambda stats: stats.has_multi_pack_index,
+        is_recommended=lambda stats: stats.packs >= MANY_PACKS_THRESHOLD,
+        apply=_apply_multi_pack_index,
+    ),
+    Setting(
+        name='index.version',
+        description='Uses index v4, which compresses paths (for a smaller, faster index).',
+        is_enabled=lambda stats: _get_config('index.version') == '4',
+        is_recommended=lambda stats: stats.tracked_files >= MANY_FILES_THRESHOLD,
+        apply=_apply_index_version,
+    ),
+    Setting(
+        name='untracked-cache',
+        description='Caches untracked directories, so they are not rescanned every time.',
+        is_enabled=lambda stats: _get_config('core.untrackedCache') == 'true',
+        is_recommended=lambda stats: stats.tracked_files >= MANY_FILES_THRESHOLD,
+        apply=_apply_untracked_cache,
+    ),
+    Setting(
+        name='split-index',
+        description=(
+            'Only rewrites changed index entries (but `add-git-staged-files` '
+            'cannot read split indexes, so it falls back to re-adding everything).'
+        ),
+        is_enabled=lambda stats: _get_config('core.splitIndex') == 'true',
+        # Only applied when explicitly requested, through `--setting split-index`.
+        is_recommended=lambda stats: False,
+        apply=_apply_split_index,
+    ),
+    Setting(
+        name='feature.manyFiles',
+        description='Opts into the defaults git recommends for repositories with many files.',
+        is_enabled=lambda stats: _get_config('feature.manyFiles') == 'true',
+        is_recommended=lambda stats: stats.tracked_files >= MANY_FILES_THRESHOLD,
+        apply=_apply_many_files,
+    ),
+    Setting(
+        name='fsmonitor',
+        description='Uses `gitfu fsmonitor`, so that git only stats paths that changed.',
+        is_enabled=lambda stats: bool(_get_config('core.fsmonitor')),
+        is_recommended=lambda stats: (
+            stats.tracked_files >= HUGE_FILES_THRESHOLD
+            and stats.supports_inotify
+        ),
+        apply=fsmonitor.enable,
+    ),
+]